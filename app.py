@@ -1,18 +1,42 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 import uvicorn
+import asyncio
+import hmac
 import os
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
+from urllib.parse import quote
 from stroy_one import story_male_one
 from stroy_two import story_male_two
 from stroy_one import story_female_one
 from stroy_two import story_female_two
-from pptx_replacer import PowerPointReplacer
-from pptx_to_pdf import pptx_to_pdf
+from artifact_io import awrite_bytes_atomic, run_io
+from conversion_backends import conversion_router
+from idempotency import (
+    MAX_KEY_LENGTH, IdempotencyConflict, IdempotencyInProgress, idempotent_runner, request_fingerprint
+)
+from memory_budget import MemoryBudgetExceeded, Reservation, job_key, memory_budget
+from memory_stats import process_memory
+from output_cache import output_cache
+from shared_cache import activate as activate_shared_cache, active_cache
+from slide_preview import SlidePreviewRenderer, SUPPORTED_FORMATS
+from storybook_pipeline import (
+    PERSISTED_ARTIFACTS, STREAM_MEDIA_TYPES, generate_storybook, output_filenames, stream_storybook
+)
+from template_compiler import TemplateValidationError, bundle_store, compile_and_install
+from template_registry import (
+    AVAILABLE_GENDERS, AVAILABLE_STORIES, all_template_paths, build_replacements, get_template_paths
+)
+from warm_cache import CacheWarmer, generation_activity, load_names
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -34,6 +58,75 @@ app.add_middleware(
 app.mount("/media", StaticFiles(directory="media"), name="media")
 
 
+def begin_generation(reservation: Reservation):
+    """
+    Count a live /generate-pptx job, streamed or not, until its reservation is released
+
+    The count is host-wide: the cache warmer of any worker only runs while no
+    worker has a live job.
+    """
+    reservation.add_release_callback(generation_activity.begin())
+
+
+# Map the read-only template/story/media cache built by serve.py, if any
+activate_shared_cache()
+
+# Preview rendering gets its own renderer, caches and threads so storefront
+# preview traffic never queues behind paid-order generation
+preview_renderer = SlidePreviewRenderer(cache_dir="preview_cache", bundle_store=bundle_store)
+preview_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="preview")
+
+
+async def report_worker_memory(interval: int):
+    """Periodically log this worker's memory usage"""
+    while True:
+        usage = process_memory()
+        print(f"📊 Worker {usage['pid']} memory: rss={usage.get('rss', 0) // (1024 * 1024)} MB, "
+              f"pss={usage.get('pss', 0) // (1024 * 1024)} MB, "
+              f"peak={usage['peak_rss'] // (1024 * 1024)} MB")
+        await asyncio.sleep(interval)
+
+@app.on_event("startup")
+async def start_memory_reporter():
+    interval = int(os.environ.get("STORYBOOK_MEMORY_REPORT_INTERVAL", "0"))
+    if interval > 0:
+        app.state.memory_reporter = asyncio.create_task(report_worker_memory(interval))
+
+
+@app.on_event("startup")
+async def start_cache_warmer():
+    # Warm popular names in the background during idle periods when a ranked list is configured
+    names_file = os.environ.get("STORYBOOK_WARM_NAMES")
+    if names_file and os.path.exists(names_file):
+        warmer = CacheWarmer(
+            load_names(names_file, int(os.environ.get("STORYBOOK_WARM_TOP", "0")) or None),
+            int(os.environ.get("STORYBOOK_WARM_BUDGET_MB", "2048")) * 1024 * 1024,
+            is_idle=generation_activity.is_idle
+        )
+        app.state.cache_warmer = warmer
+        warmer.start()
+
+
+@app.on_event("startup")
+async def warm_preview_layouts():
+    # Load the preview layouts serve.py (or template bundles) prepared on the preview threads.
+    # Workers never convert base PDFs at startup; a template without one is converted by
+    # the preview renderer's own engines on its first preview request.
+    asyncio.get_running_loop().run_in_executor(
+        preview_executor,
+        preview_renderer.warm,
+        all_template_paths(),
+        list(build_replacements("").keys()),
+        False
+    )
+
+
+@app.on_event("shutdown")
+async def stop_conversion_backends():
+    conversion_router.shutdown()
+    preview_renderer.router.shutdown()
+
+
 class StoryRequest(BaseModel):
     name: str
     story_id: int
@@ -43,9 +136,29 @@ class PptxRequest(BaseModel):
     name: str
     story_id: int
     gender: str
+    delivery: str = "links"
+    persist: bool = True
+    order_id: Optional[str] = None
+
+def media_url(base_url: str, path: str) -> str:
+    """Public URL of a file under the media folder"""
+    return f"{base_url}/media/{quote(Path(path).relative_to('media').as_posix())}"
+
+def content_disposition(filename: str) -> str:
+    """Attachment header for any filename: an ASCII fallback plus the RFC 5987 UTF-8 form"""
+    fallback = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+    fallback = re.sub(r'[^A-Za-z0-9._ -]', "_", fallback).strip() or "download"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
 
 def get_all_page_images(page_number: int, story_folder: str) -> list:
     """Get all images for a specific page"""
+    # Use the shared media index when running under the production launcher
+    cache = active_cache()
+    if cache is not None:
+        cached_images = cache.page_images(story_folder, page_number)
+        if cached_images is not None:
+            return cached_images
+    
     possible_extensions = ['.jpeg', '.jpg', '.png']
     images = []
     image_index = 1
@@ -93,7 +206,10 @@ async def generate_story(request: StoryRequest, req: Request):
     
     # Get the story function and folder
     story_config = story_mapping[request.story_id]
-    pages = await story_config["function"](request.name)
+    cache = active_cache()
+    pages = cache.story_pages(request.story_id, request.gender, request.name) if cache else None
+    if pages is None:
+        pages = await story_config["function"](request.name)
     story_folder = story_config["folder"]
     
     # Get base URL from request
@@ -122,7 +238,12 @@ async def generate_story(request: StoryRequest, req: Request):
     }
 
 @app.post("/generate-pptx")
-async def generate_pptx(request: PptxRequest, req: Request):
+async def generate_pptx(
+    request: PptxRequest,
+    req: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """
     Generate a personalized PowerPoint storybook
     
@@ -130,38 +251,25 @@ async def generate_pptx(request: PptxRequest, req: Request):
         name: The character name to use in the story
         story_id: The story identifier (e.g., 1 for story_one, 2 for story_two)
         gender: The gender (male or female)
+        delivery: 'links' (default), or 'pptx', 'pdf', 'zip' to stream the artifact back
+        persist: Keep copies under /media when streaming (default True)
+        order_id: Shopify order id; retries of the same order line reuse the first result (optional, links only)
+        Idempotency-Key: Header; retries with the same key reuse the first result (optional, links only)
     
     Returns:
-        A JSON response with the download URL for the generated PPTX
+        A JSON response with the download URLs, or the streamed artifact
     """
     try:
         # Validate story_id
-        if request.story_id not in [1, 2]:
+        if request.story_id not in AVAILABLE_STORIES:
             raise HTTPException(status_code=404, detail=f"Story with id '{request.story_id}' not found")
         
         # Validate gender
-        if request.gender.lower() not in ["male", "female"]:
+        if request.gender.lower() not in AVAILABLE_GENDERS:
             raise HTTPException(status_code=400, detail="Gender must be 'male' or 'female'")
         
-        # Map story_id and gender to template files
-        template_mapping = {
-            (1, "male"): "story_book/Storybook_Template_1_male.pptx",
-            (1, "female"): "story_book/Storybook_Template_1_female.pptx",
-            (2, "male"): "story_book/Storybook_Template_2_male.pptx",
-            (2, "female"): "story_book/Storybook_Template_2_female.pptx"
-        }
-
-        template_cover_mapping = {
-            (1, "male"): "story_book/cover/Storybook_cover_1_male.pptx",
-            (1, "female"): "story_book/cover/Storybook_cover_1_female.pptx",
-            (2, "male"): "story_book/cover/Storybook_cover_2_male.pptx",
-            (2, "female"): "story_book/cover/Storybook_cover_2_female.pptx"
-        }
-        
         # Get the appropriate template based on story_id and gender
-        template_key = (request.story_id, request.gender.lower())
-        template_path = template_mapping.get(template_key)
-        template_path_cover = template_cover_mapping.get(template_key)
+        template_path, template_path_cover = get_template_paths(request.story_id, request.gender)
         
         if not template_path:
             raise HTTPException(status_code=400, detail=f"No template found for story_id={request.story_id} and gender={request.gender}")
@@ -176,48 +284,104 @@ async def generate_pptx(request: PptxRequest, req: Request):
         # Create folder name: name_gender_timestamp (e.g., emma_male_20251030_143025)
         folder_name = f"{request.name.lower()}_{request.gender.lower()}_{timestamp}"
         output_dir = Path("media") / folder_name
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Create replacer instance
-        replacer = PowerPointReplacer(template_path)
-        replacer_cover =  PowerPointReplacer(template_path_cover)
         
         # Prepare replacements
-        replacements = {
-            '{{Child_Name}}': request.name,
-            '{{CHILD_NAME_UPPER}}': request.name.upper()
-        }
-        
-        # Generate output filename
-        output_filename = f"{request.name}_Storybook.pptx"
-        output_path = output_dir / output_filename
+        replacements = build_replacements(request.name)
         
-        output_filename_cover = f"{request.name}_cover_Storybook.pptx"
-        output_path_cover = output_dir / output_filename_cover
-
-        # Replace text and save
-        created_file = replacer.replace_text(replacements, str(output_path))
-
-        created_file_cover = replacer_cover.replace_text(replacements, str(output_path_cover))
-
-        # Convert pptx to pdf
-        pdf_path = pptx_to_pdf(str(output_path))
-
-        pdf_path_cover = pptx_to_pdf(str(output_path_cover))
-
-        # Extract just the PDF filename from the full path
-        pdf_filename = Path(pdf_path).name
-        pdf_filename_cover = Path(pdf_path_cover).name
-
         # Get base URL from request
         base_url = str(req.base_url).rstrip('/')
+        filenames = output_filenames(request.name)
+        budget_key = job_key(request.story_id, request.gender)
+        
+        # Stream the artifact back while it is being produced
+        if request.delivery != "links":
+            if request.delivery not in STREAM_MEDIA_TYPES:
+                raise HTTPException(status_code=400, detail="Delivery must be 'links', 'pptx', 'pdf' or 'zip'")
+            
+            if request.delivery == "zip":
+                download_name = f"{request.name}_Storybook.zip"
+            else:
+                download_name = filenames[f"story_{request.delivery}"]
+            
+            headers = {"Content-Disposition": content_disposition(download_name)}
+            if request.persist:
+                # Persisted copies stay available under /media with range/resume support
+                headers["X-Artifact-Urls"] = ", ".join(
+                    media_url(base_url, str(output_dir / filenames[key]))
+                    for key in PERSISTED_ARTIFACTS[request.delivery]
+                )
+            
+            # A streamed artifact is produced once, for this response only, so a retry key cannot be honoured
+            if idempotency_key or request.order_id:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Idempotency-Key and order_id are only supported with delivery 'links'"
+                )
+            
+            # The reservation is held until the stream has been fully produced
+            reservation = await memory_budget.acquire(budget_key)
+            begin_generation(reservation)
+            try:
+                stream = stream_storybook(
+                    template_path,
+                    template_path_cover,
+                    replacements,
+                    output_dir,
+                    request.name,
+                    request.delivery,
+                    persist=request.persist
+                )
+                return StreamingResponse(
+                    memory_budget.guard_stream(reservation, stream),
+                    media_type=STREAM_MEDIA_TYPES[request.delivery],
+                    headers=headers,
+                    # Also release if the client goes away before the stream ever starts
+                    background=BackgroundTask(reservation.release)
+                )
+            except BaseException:
+                # The response never got built, so nothing else will release the reservation
+                reservation.release()
+                raise
+        
+        async def generate():
+            # Popular names are usually pre-generated by the cache warming job
+            artifacts = await run_io(output_cache.lookup, request.story_id, request.gender, request.name)
+            if artifacts is None:
+                # Wait for memory headroom; sheds with 503 when the budget stays exhausted
+                reservation = await memory_budget.acquire(budget_key)
+                
+                # Replace text, save and convert pptx to pdf
+                # Run off the event loop so slow disks and conversions never stall other requests
+                begin_generation(reservation)
+                try:
+                    artifacts = await asyncio.get_running_loop().run_in_executor(
+                        None, memory_budget.run_measured, reservation,
+                        generate_storybook, template_path, template_path_cover, replacements, output_dir, request.name
+                    )
+                finally:
+                    reservation.release()
+            return artifacts
+        
+        # Webhook and storefront retries reuse the original result instead of generating again
+        fingerprint = request_fingerprint(story_id=request.story_id, gender=request.gender.lower(), name=request.name)
+        if idempotency_key is None and request.order_id:
+            idempotency_key = f"order:{request.order_id}:{fingerprint}"
+        
+        if idempotency_key:
+            if len(idempotency_key) > MAX_KEY_LENGTH:
+                raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+            artifacts, replayed = await idempotent_runner.run(idempotency_key, fingerprint, generate)
+            if replayed:
+                response.headers["Idempotent-Replayed"] = "true"
+        else:
+            artifacts = await generate()
         
         # Build download URL
-        download_url = f"{base_url}/media/{folder_name}/{output_filename}"
-        download_url_pdf = f"{base_url}/media/{folder_name}/{pdf_filename}"
+        download_url = media_url(base_url, artifacts['story_pptx'])
+        download_url_pdf = media_url(base_url, artifacts['story_pdf'])
 
-        download_cover_url = f"{base_url}/media/{folder_name}/{output_filename_cover}"
-        download_cover_url_pdf = f"{base_url}/media/{folder_name}/{pdf_filename_cover}"
+        download_cover_url = media_url(base_url, artifacts['cover_pptx'])
+        download_cover_url_pdf = media_url(base_url, artifacts['cover_pdf'])
         
         return {
             "success": True,
@@ -233,21 +397,213 @@ async def generate_pptx(request: PptxRequest, req: Request):
             "status_code": 200
         }
     
+    except HTTPException:
+        raise
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except FileNotFoundError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating PowerPoint: {str(e)}")
 
+@app.get("/preview")
+async def preview(
+    story_id: int,
+    gender: str,
+    name: str,
+    page: int = 1,
+    part: str = "cover",
+    width: int = 600,
+    format: str = "png"
+):
+    """
+    Render a quick preview image of a personalized page
+    
+    Args:
+        story_id: The story identifier (e.g., 1 for story_one, 2 for story_two)
+        gender: The gender (male or female)
+        name: The character name to use in the story
+        page: 1-based page number within the selected part
+        part: 'cover' or 'story'
+        width: Output width in pixels (64-2000), rounded up to a preview width bucket
+        format: 'png' or 'webp'
+    
+    Returns:
+        The rendered page image
+    """
+    if story_id not in AVAILABLE_STORIES:
+        raise HTTPException(status_code=404, detail=f"Story with id '{story_id}' not found")
+    
+    if gender.lower() not in AVAILABLE_GENDERS:
+        raise HTTPException(status_code=400, detail="Gender must be 'male' or 'female'")
+    
+    if part not in ("cover", "story"):
+        raise HTTPException(status_code=400, detail="Part must be 'cover' or 'story'")
+    
+    if format.lower() not in SUPPORTED_FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be 'png' or 'webp'")
+    
+    if not 64 <= width <= 2000:
+        raise HTTPException(status_code=400, detail="Width must be between 64 and 2000 pixels")
+    
+    template_path, template_path_cover = get_template_paths(story_id, gender)
+    template = template_path_cover if part == "cover" else template_path
+    
+    if not template or not os.path.exists(template):
+        raise HTTPException(status_code=500, detail=f"Template file not found: {template}")
+    
+    try:
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(
+            preview_executor,
+            preview_renderer.render_page,
+            template,
+            page,
+            build_replacements(name),
+            width,
+            format
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rendering preview: {str(e)}")
+    
+    return Response(
+        content=image,
+        media_type=SUPPORTED_FORMATS[format.lower()],
+        headers={"Cache-Control": "public, max-age=3600"}
+    )
+
+def require_admin(authorization: Optional[str]):
+    """Reject requests without the admin token; admin endpoints are off when no token is configured"""
+    admin_token = os.environ.get("STORYBOOK_ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode("utf-8"), admin_token.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+
+async def read_limited_body(req: Request, max_bytes: int) -> bytes:
+    """Read a request body, rejecting it with 413 as soon as it exceeds max_bytes"""
+    content_length = req.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Request body exceeds {max_bytes // (1024 * 1024)} MB")
+    
+    chunks = []
+    received = 0
+    async for chunk in req.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Request body exceeds {max_bytes // (1024 * 1024)} MB")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+@app.post("/templates/{story_id}/{gender}/{part}")
+async def upload_template(
+    story_id: int,
+    gender: str,
+    part: str,
+    req: Request,
+    authorization: Optional[str] = Header(None)
+):
+    """
+    Validate, compile and hot-swap a storybook template
+    
+    The request body is the raw .pptx file. Requires `Authorization: Bearer <STORYBOOK_ADMIN_TOKEN>`;
+    the endpoint does not exist when no admin token is configured.
+    
+    Args:
+        story_id: The story identifier (e.g., 1 for story_one, 2 for story_two)
+        gender: The gender (male or female)
+        part: 'story' or 'cover'
+    
+    Returns:
+        A JSON summary of the installed template bundle
+    """
+    require_admin(authorization)
+    
+    if story_id not in AVAILABLE_STORIES:
+        raise HTTPException(status_code=404, detail=f"Story with id '{story_id}' not found")
+    
+    if gender.lower() not in AVAILABLE_GENDERS:
+        raise HTTPException(status_code=400, detail="Gender must be 'male' or 'female'")
+    
+    if part not in ("cover", "story"):
+        raise HTTPException(status_code=400, detail="Part must be 'cover' or 'story'")
+    
+    body = await read_limited_body(req, int(os.environ.get("STORYBOOK_MAX_TEMPLATE_MB", "50")) * 1024 * 1024)
+    if not body:
+        raise HTTPException(status_code=400, detail="Request body must be a .pptx file")
+    
+    upload_dir = Path("compiled_templates") / "uploads"
+    upload_path = upload_dir / f"{story_id}_{gender.lower()}_{part}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.pptx"
+    await awrite_bytes_atomic(upload_path, body)
+    
+    try:
+        bundle = await asyncio.get_running_loop().run_in_executor(
+            None, compile_and_install, str(upload_path), story_id, gender.lower(), part
+        )
+    except TemplateValidationError as e:
+        raise HTTPException(status_code=422, detail={"message": "Template validation failed", "problems": e.problems})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error compiling template: {str(e)}")
+    finally:
+        upload_path.unlink(missing_ok=True)
+    
+    return {
+        "success": True,
+        "message": "Template compiled and installed",
+        "story_id": story_id,
+        "gender": gender.lower(),
+        "part": part,
+        "bundle": bundle.summary()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Report per-backend conversion metrics, the generation memory budget and idempotent replays
+    
+    Returns:
+        Calls, failures and latency of each conversion backend, and the
+        reserved/queued/shed counters of the memory budget in this worker
+    """
+    return {
+        "conversion_backends": conversion_router.metrics(),
+        "memory_budget": memory_budget.metrics(),
+        "idempotency": idempotent_runner.metrics()
+    }
+
+@app.get("/memory")
+async def memory():
+    """
+    Report the memory usage of the worker process that serves the request
+    
+    Returns:
+        Process memory in bytes, plus the size of the shared cache mapping
+    """
+    cache = active_cache()
+    return {
+        "worker": process_memory(),
+        "shared_cache_bytes": cache.size_bytes if cache else 0
+    }
+
 @app.get("/")
 async def root():
     return {
         "message": "Story Generator API",
         "endpoints": {
             "generate_story": "POST /generate-story with {name: 'your_name', story_id: 1 or 2, gender: 'male' or 'female'}",
-            "generate_pptx": "POST /generate-pptx with {name: 'your_name', story_id: 1 or 2, gender: 'male' or 'female'}"
+            "generate_pptx": "POST /generate-pptx with {name: 'your_name', story_id: 1 or 2, gender: 'male' or 'female'}",
+            "preview": "GET /preview?story_id=1&gender=male&name=your_name&page=1&part=cover&width=600&format=png"
         },
-        "available_stories": [1, 2],
-        "available_genders": ["male", "female"]
+        "available_stories": AVAILABLE_STORIES,
+        "available_genders": AVAILABLE_GENDERS
     }
 
 if __name__ == "__main__":
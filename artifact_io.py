@@ -0,0 +1,190 @@
+"""
+Artifact I/O
+Buffered, atomic and batch-fsynced writes for generated artifacts.
+
+Artifacts are built in a staging folder outside media/ and published with a
+rename, so a half-written file is never visible under /media. The async
+helpers run the disk work on a dedicated thread pool so slow or network-backed
+volumes do not hold up the event loop.
+"""
+
+import asyncio
+import errno
+import functools
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Union
+
+
+IO_BUFFER_SIZE = 1024 * 1024
+
+# Must be on the same filesystem as media/ for the publish rename to be atomic
+STAGING_ROOT = os.environ.get("STORYBOOK_STAGING_DIR", ".staging")
+
+# Set STORYBOOK_FSYNC=0 to skip fsync, e.g. on throwaway benchmark volumes
+FSYNC_ENABLED = os.environ.get("STORYBOOK_FSYNC", "1") != "0"
+
+_io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="artifact-io")
+
+
+class FsyncBatch:
+    """Collect written files and flush them to stable storage together"""
+
+    def __init__(self, enabled: bool = FSYNC_ENABLED):
+        self.enabled = enabled
+        self._files: List[Path] = []
+        self._dirs = set()
+
+    def add(self, path: Union[str, Path]):
+        path = Path(path)
+        self._files.append(path)
+        self._dirs.add(path.parent)
+
+    def add_dir(self, path: Union[str, Path]):
+        self._dirs.add(Path(path))
+
+    def commit(self):
+        """fsync every collected file, then each containing directory once"""
+        if not self.enabled:
+            self._files.clear()
+            self._dirs.clear()
+            return
+
+        for path in self._files:
+            if path.exists():
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        # Directory fsync makes the renames durable; not supported on Windows
+        if sys.platform != "win32":
+            for directory in self._dirs:
+                if directory.exists():
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+
+        self._files.clear()
+        self._dirs.clear()
+
+
+def make_staging_dir(prefix: str = "job_") -> Path:
+    """Create a private folder to build artifacts in"""
+    Path(STAGING_ROOT).mkdir(parents=True, exist_ok=True)
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=STAGING_ROOT))
+
+
+def write_bytes(path: Union[str, Path], data: bytes, batch: Optional[FsyncBatch] = None) -> str:
+    """
+    Write a file through a large buffer
+
+    Args:
+        path: Destination path (normally inside a staging folder)
+        data: File contents
+        batch: FsyncBatch to register the file with (optional)
+
+    Returns:
+        The path written
+    """
+    path = Path(path)
+    with open(path, "wb", buffering=IO_BUFFER_SIZE) as f:
+        f.write(data)
+    if batch is not None:
+        batch.add(path)
+    return str(path)
+
+
+def write_bytes_atomic(path: Union[str, Path], data: bytes, batch: Optional[FsyncBatch] = None) -> str:
+    """
+    Write a file under a temporary name and rename it into place
+
+    Args:
+        path: Final destination path
+        data: File contents
+        batch: FsyncBatch to commit before the rename (optional, default: fsync just this file)
+
+    Returns:
+        The final path
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    os.close(fd)
+    try:
+        own_batch = batch or FsyncBatch()
+        write_bytes(tmp_name, data, own_batch)
+        own_batch.commit()
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+    return str(path)
+
+
+def _move_into(source: Path, target_dir: Path):
+    """Move each file of a staging folder into an existing folder, one atomic replace per file"""
+    for item in source.iterdir():
+        destination = target_dir / item.name
+        try:
+            os.replace(item, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Staging is on another filesystem: copy next to the target, then rename
+            tmp = target_dir / f".{item.name}.tmp"
+            shutil.copyfile(item, tmp)
+            os.replace(tmp, destination)
+
+
+def publish_dir(staging_dir: Union[str, Path], output_dir: Union[str, Path],
+                batch: Optional[FsyncBatch] = None) -> str:
+    """
+    Make a finished staging folder visible at its final location
+
+    Args:
+        staging_dir: Folder holding the complete artifacts
+        output_dir: Final folder (e.g. under media/)
+        batch: FsyncBatch holding the staged files, committed before publishing (optional)
+
+    Returns:
+        The final folder path
+    """
+    staging_dir = Path(staging_dir)
+    output_dir = Path(output_dir)
+
+    batch = batch or FsyncBatch()
+    batch.commit()
+
+    output_dir.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        # The whole folder appears at once
+        os.rename(staging_dir, output_dir)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY, errno.EXDEV) and not output_dir.exists():
+            raise
+        output_dir.mkdir(parents=True, exist_ok=True)
+        _move_into(staging_dir, output_dir)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    batch.add_dir(output_dir.parent)
+    batch.add_dir(output_dir)
+    batch.commit()
+    return str(output_dir)
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking disk operation on the artifact I/O thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(func, *args, **kwargs))
+
+
+async def awrite_bytes_atomic(path: Union[str, Path], data: bytes) -> str:
+    return await run_io(write_bytes_atomic, path, data)
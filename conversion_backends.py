@@ -0,0 +1,532 @@
+"""
+Conversion Backends
+Pluggable PPTX -> PDF engines and a router that picks the fastest one able
+to handle each job, falls back on failure and keeps per-backend metrics.
+
+Backends:
+    powerpoint_com    PowerPoint over COM (Windows only)
+    libreoffice_pool  Persistent LibreOffice processes driven through unoserver
+    pdf_overlay       Draws the personalized text onto a compiled bundle's base PDF in a built-in
+                      font; not in the default chain because it drops the template's fonts
+    libreoffice_cli   One headless LibreOffice run per conversion
+    stub              Writes a blank PDF without converting (tests and benchmarks)
+
+Set STORYBOOK_CONVERSION_BACKENDS to a comma-separated list to choose which
+backends the router may use, e.g. "stub" or "pdf_overlay,libreoffice_cli" for benchmarks.
+"""
+
+import os
+import platform
+import queue
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+DEFAULT_BACKENDS = "powerpoint_com,libreoffice_pool,libreoffice_cli"
+
+# Latency smoothing for the router's running averages
+EWMA_ALPHA = 0.2
+
+# A failed attempt adds this much to a backend's rank, so flaky backends sink in the routing order
+FAILURE_PENALTY_SECONDS = 30.0
+
+# The penalty halves every this many seconds, so a backend that failed once gets picked again
+FAILURE_PENALTY_HALF_LIFE = 30.0
+
+# A one-page blank PDF, enough for anything that only needs a valid file
+STUB_PDF = (
+    b"%PDF-1.4\n"
+    b"1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n"
+    b"%%EOF\n"
+)
+
+
+class BackendUnsupported(Exception):
+    """Raised when a backend cannot handle a job at all, as opposed to a transient failure"""
+
+
+class JobUnsupported(Exception):
+    """Raised when a backend cannot handle this particular job, e.g. a name that does not fit; not held against it"""
+
+
+class ConversionJob:
+    """One PPTX -> PDF conversion"""
+
+    def __init__(self, pptx_path: Path, output_path: Path, bundle=None, replacements: Optional[Dict[str, str]] = None):
+        self.pptx_path = pptx_path
+        self.output_path = output_path
+        self.bundle = bundle
+        self.replacements = replacements
+
+    @property
+    def template_key(self) -> Optional[str]:
+        """Stable identity of the template, used to remember what each backend can handle"""
+        return self.bundle.digest if self.bundle is not None else None
+
+
+class ConversionBackend:
+    """Base class for conversion engines"""
+
+    name = "base"
+
+    # Prior latency guess used until the router has measured the backend
+    expected_seconds = 10.0
+
+    def available(self) -> bool:
+        """Whether the engine is installed and usable on this host"""
+        return True
+
+    def can_handle(self, job: ConversionJob) -> bool:
+        """Whether the engine can convert this particular job"""
+        return True
+
+    def prepare(self):
+        """Start long-lived resources before a conversion; the router keeps this out of the measured latency"""
+
+    def convert(self, job: ConversionJob) -> str:
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Release long-lived resources such as office processes"""
+
+
+class LibreOfficeCLIBackend(ConversionBackend):
+    name = "libreoffice_cli"
+    expected_seconds = 8.0
+
+    def available(self) -> bool:
+        return shutil.which("libreoffice") is not None or shutil.which("soffice") is not None
+
+    def convert(self, job: ConversionJob) -> str:
+        """Convert using LibreOffice command line (cross-platform)."""
+        pptx_path = job.pptx_path
+        output_path = job.output_path
+        output_dir = output_path.parent
+
+        # LibreOffice conversion command
+        cmd = [
+            shutil.which('libreoffice') or shutil.which('soffice') or 'libreoffice',
+            '--headless',
+            '--convert-to', 'pdf',
+            '--outdir', str(output_dir),
+            str(pptx_path)
+        ]
+
+        try:
+            subprocess.run(
+                cmd,
+                check=True,
+                capture_output=True,
+                text=True,
+                timeout=300  # 5 minutes timeout
+            )
+
+            # LibreOffice creates PDF with same name as input
+            default_pdf = output_dir / f"{pptx_path.stem}.pdf"
+
+            # Rename if output path is different (os.replace is atomic and overwrites on every platform)
+            if default_pdf != output_path and default_pdf.exists():
+                os.replace(default_pdf, output_path)
+
+            if output_path.exists():
+                print(f"✓ Converted using LibreOffice: {output_path}")
+                return str(output_path)
+            else:
+                raise Exception("PDF was not created")
+
+        except subprocess.TimeoutExpired:
+            raise Exception("Conversion timeout (5 minutes exceeded)")
+        except subprocess.CalledProcessError as e:
+            raise Exception(f"LibreOffice conversion failed: {e.stderr}")
+        except FileNotFoundError:
+            raise BackendUnsupported(
+                "LibreOffice not found. Please install:\n"
+                "  Linux: sudo apt-get install libreoffice\n"
+                "  Windows: Download from https://www.libreoffice.org/"
+            )
+
+
+class PowerPointCOMBackend(ConversionBackend):
+    name = "powerpoint_com"
+    expected_seconds = 6.0
+
+    def available(self) -> bool:
+        if platform.system() != "Windows":
+            return False
+        try:
+            import comtypes.client  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def convert(self, job: ConversionJob) -> str:
+        """Convert using Windows COM interface (PowerPoint)."""
+        import comtypes
+        import comtypes.client
+
+        # Conversions run on executor threads, which have not initialised COM themselves
+        comtypes.CoInitialize()
+        try:
+            powerpoint = comtypes.client.CreateObject("Powerpoint.Application")
+            powerpoint.Visible = 0  # Run in background
+
+            try:
+                presentation = powerpoint.Presentations.Open(str(job.pptx_path), WithWindow=False)
+                presentation.SaveAs(str(job.output_path), 32)  # 32 = PDF format
+                presentation.Close()
+
+                print(f"✓ Converted using PowerPoint: {job.output_path}")
+                return str(job.output_path)
+
+            finally:
+                powerpoint.Quit()
+                # Drop the proxy while COM is still initialised on this thread
+                del powerpoint
+        finally:
+            comtypes.CoUninitialize()
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _UnoServer:
+    """One long-running LibreOffice instance behind unoserver"""
+
+    def __init__(self):
+        self.port = None
+        self.uno_port = None
+        self.process = None
+
+    def ensure_running(self, startup_timeout: float = 60.0):
+        if self.process is not None and self.process.poll() is None:
+            return
+        # Free ports per start, so several uvicorn workers on one host never collide
+        self.port = _free_port()
+        self.uno_port = _free_port()
+        self.process = subprocess.Popen(
+            ["unoserver", "--interface", "127.0.0.1", "--port", str(self.port), "--uno-port", str(self.uno_port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + startup_timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                    return
+            except OSError:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.25)
+        self.stop()
+        raise Exception(f"unoserver on port {self.port} did not start")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+
+class LibreOfficePoolBackend(ConversionBackend):
+    name = "libreoffice_pool"
+    expected_seconds = 2.0
+
+    def __init__(self, size: int = int(os.environ.get("STORYBOOK_LIBREOFFICE_POOL_SIZE", "2"))):
+        """
+        Pool of persistent LibreOffice processes, so conversions skip office start-up
+
+        Args:
+            size: Number of LibreOffice processes, started lazily on first use
+        """
+        self.size = size
+        # Last returned first, so conversions keep landing on processes that are already running
+        self._servers = queue.LifoQueue()
+        for _ in range(size):
+            self._servers.put(_UnoServer())
+
+    def available(self) -> bool:
+        return shutil.which("unoserver") is not None and shutil.which("unoconvert") is not None
+
+    def prepare(self):
+        """Make sure the process the next conversion leases is running, starting it on first use or after a restart"""
+        server = self._servers.get()
+        try:
+            server.ensure_running()
+        finally:
+            self._servers.put(server)
+
+    def convert(self, job: ConversionJob) -> str:
+        server = self._servers.get()
+        try:
+            server.ensure_running()
+            subprocess.run(
+                ["unoconvert", "--host", "127.0.0.1", "--port", str(server.port),
+                 "--convert-to", "pdf", str(job.pptx_path), str(job.output_path)],
+                check=True,
+                capture_output=True,
+                text=True,
+                timeout=300
+            )
+        except subprocess.CalledProcessError as e:
+            # A wedged office process is restarted on its next lease
+            server.stop()
+            raise Exception(f"unoconvert failed: {e.stderr}")
+        except subprocess.TimeoutExpired:
+            server.stop()
+            raise Exception("Conversion timeout (5 minutes exceeded)")
+        finally:
+            self._servers.put(server)
+
+        if not job.output_path.exists():
+            raise Exception("PDF was not created")
+        print(f"✓ Converted using LibreOffice pool: {job.output_path}")
+        return str(job.output_path)
+
+    def shutdown(self):
+        servers = []
+        while not self._servers.empty():
+            servers.append(self._servers.get())
+        for server in servers:
+            server.stop()
+            self._servers.put(server)
+
+
+class PdfOverlayBackend(ConversionBackend):
+    name = "pdf_overlay"
+    expected_seconds = 0.1
+
+    def available(self) -> bool:
+        try:
+            import fitz  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def can_handle(self, job: ConversionJob) -> bool:
+        return job.bundle is not None and job.replacements is not None and os.path.exists(job.bundle.base_pdf)
+
+    def convert(self, job: ConversionJob) -> str:
+        import fitz  # PyMuPDF
+
+        aligns = {"left": 0, "center": 1, "right": 2}
+
+        with fitz.open(job.bundle.base_pdf) as doc:
+            for page_number, boxes in job.bundle.text_boxes().items():
+                page = doc[page_number - 1]
+                # Bundle geometry is in slide points; scale to the PDF page
+                scale = page.rect.width / job.bundle.slide_width
+                for box in boxes:
+                    text = "\n".join(box.paragraphs)
+                    for placeholder, replacement in job.replacements.items():
+                        text = text.replace(placeholder, replacement)
+                    rect = fitz.Rect(
+                        box.left * scale, box.top * scale,
+                        (box.left + box.width) * scale, (box.top + box.height) * scale
+                    )
+                    overflow = page.insert_textbox(
+                        rect,
+                        text,
+                        fontsize=box.font_size * scale,
+                        fontname="helv",
+                        color=tuple(c / 255 for c in box.color),
+                        align=aligns.get(box.align, 0)
+                    )
+                    if overflow < 0:
+                        # The name does not fit the box with the built-in font; let a real office engine lay it out
+                        raise JobUnsupported(f"Text overflows its box on page {page_number}")
+            doc.save(str(job.output_path), garbage=3, deflate=True)
+
+        print(f"✓ Converted using PDF overlay: {job.output_path}")
+        return str(job.output_path)
+
+
+class StubBackend(ConversionBackend):
+    name = "stub"
+    expected_seconds = 0.0
+
+    def convert(self, job: ConversionJob) -> str:
+        job.output_path.write_bytes(STUB_PDF)
+        return str(job.output_path)
+
+
+class BackendStats:
+    """Latency and outcome counters for one backend"""
+
+    def __init__(self, expected_seconds: float):
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.declined = 0
+        self.total_seconds = 0.0
+        self.ewma_seconds = expected_seconds
+        self.penalty_seconds = 0.0
+        self.penalized_at = 0.0
+        self.last_error = None
+
+    def current_penalty(self) -> float:
+        if not self.penalty_seconds:
+            return 0.0
+        elapsed = time.monotonic() - self.penalized_at
+        return self.penalty_seconds * 0.5 ** (elapsed / FAILURE_PENALTY_HALF_LIFE)
+
+    @property
+    def rank_seconds(self) -> float:
+        """Routing order key: measured latency plus the decaying failure penalty"""
+        return self.ewma_seconds + self.current_penalty()
+
+    def record(self, seconds: float, error: Optional[Exception] = None):
+        self.calls += 1
+        if error is None:
+            self.successes += 1
+            self.total_seconds += seconds
+            # The first measurement replaces the prior guess
+            if self.successes == 1:
+                self.ewma_seconds = seconds
+            else:
+                self.ewma_seconds += EWMA_ALPHA * (seconds - self.ewma_seconds)
+        else:
+            self.failures += 1
+            self.last_error = str(error)
+            self.penalty_seconds = self.current_penalty() + FAILURE_PENALTY_SECONDS
+            self.penalized_at = time.monotonic()
+
+    def decline(self, error: Exception):
+        """Count a job the backend passed on without holding it against its latency"""
+        self.calls += 1
+        self.declined += 1
+        self.last_error = str(error)
+
+    def to_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.failures,
+            "declined": self.declined,
+            "ewma_seconds": round(self.ewma_seconds, 4),
+            "penalty_seconds": round(self.current_penalty(), 4),
+            "mean_seconds": round(self.total_seconds / self.successes, 4) if self.successes else None,
+            "last_error": self.last_error
+        }
+
+
+class ConversionRouter:
+    def __init__(self, backends: List[ConversionBackend]):
+        """
+        Route conversions to the fastest capable backend
+
+        Args:
+            backends: Candidate backends
+        """
+        self.backends = backends
+        self._stats = {backend.name: BackendStats(backend.expected_seconds) for backend in backends}
+        self._incapable = set()
+        self._lock = threading.Lock()
+
+    def candidates(self, job: ConversionJob) -> List[ConversionBackend]:
+        """Capable backends for a job, fastest first by measured latency"""
+        with self._lock:
+            usable = [
+                backend for backend in self.backends
+                if (backend.name, job.template_key) not in self._incapable
+                and backend.available()
+                and backend.can_handle(job)
+            ]
+            return sorted(usable, key=lambda backend: self._stats[backend.name].rank_seconds)
+
+    def convert(self, job: ConversionJob) -> str:
+        """
+        Convert with the fastest capable backend, falling back to the next on failure
+
+        Returns:
+            Path to the generated PDF file
+
+        Raises:
+            Exception: If every capable backend fails
+        """
+        candidates = self.candidates(job)
+        if not candidates:
+            raise Exception("No conversion backend available. Please install LibreOffice or unoserver.")
+
+        errors = []
+        for backend in candidates:
+            started = time.perf_counter()
+            try:
+                backend.prepare()
+                # Office start-up is paid once, not per conversion, so it must not rank the backend
+                started = time.perf_counter()
+                result = backend.convert(job)
+            except JobUnsupported as e:
+                with self._lock:
+                    self._stats[backend.name].decline(e)
+                print(f"{backend.name} passed on this job ({e}), trying next backend...")
+                errors.append(f"{backend.name}: {e}")
+                continue
+            except Exception as e:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self._stats[backend.name].record(elapsed, e)
+                    if isinstance(e, BackendUnsupported) and job.template_key is not None:
+                        # Remember it so later jobs for this template skip straight past it
+                        self._incapable.add((backend.name, job.template_key))
+                print(f"{backend.name} failed ({e}), trying next backend...")
+                errors.append(f"{backend.name}: {e}")
+                continue
+
+            with self._lock:
+                self._stats[backend.name].record(time.perf_counter() - started)
+            return result
+
+        raise Exception(f"All conversion backends failed: {'; '.join(errors)}")
+
+    def shutdown(self):
+        for backend in self.backends:
+            backend.shutdown()
+
+    def metrics(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                backend.name: dict(self._stats[backend.name].to_dict(), available=backend.available())
+                for backend in self.backends
+            }
+
+
+BACKEND_TYPES = {
+    backend.name: backend
+    for backend in [PowerPointCOMBackend, LibreOfficePoolBackend, PdfOverlayBackend, LibreOfficeCLIBackend, StubBackend]
+}
+
+
+def build_router(names: Optional[str] = None) -> ConversionRouter:
+    """
+    Build a router from a comma-separated backend list
+
+    Args:
+        names: Backend names, defaults to STORYBOOK_CONVERSION_BACKENDS or DEFAULT_BACKENDS
+    """
+    names = names or os.environ.get("STORYBOOK_CONVERSION_BACKENDS", DEFAULT_BACKENDS)
+    backends = []
+    for name in names.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        if name not in BACKEND_TYPES:
+            raise ValueError(f"Unknown conversion backend: {name}")
+        backends.append(BACKEND_TYPES[name]())
+    return ConversionRouter(backends)
+
+
+conversion_router = build_router()
@@ -0,0 +1,278 @@
+"""
+Idempotency
+Make retried /generate-pptx requests reuse the original result.
+
+Keys and their results are kept in a local SQLite file shared by all worker
+processes on the host, and expire after a TTL. A retry whose generation is
+still running attaches to it: directly when it runs in the same worker, by
+polling the store when another worker owns it. A key whose owner died is
+taken over once its pending claim goes stale.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from artifact_io import run_io
+
+
+STORE_PATH = os.environ.get("STORYBOOK_IDEMPOTENCY_DB", "idempotency.sqlite3")
+
+MAX_KEY_LENGTH = 255
+
+CLAIMED = "claimed"
+PENDING = "pending"
+DONE = "done"
+
+
+class IdempotencyConflict(Exception):
+    """Raised when a key is reused for a different request"""
+
+
+class IdempotencyInProgress(Exception):
+    """Raised when the original request is still running after the wait timeout"""
+
+    def __init__(self, message: str, retry_after: int = 10):
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+def request_fingerprint(**fields) -> str:
+    """Stable hash of the request fields a key is bound to"""
+    raw = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        path: str = STORE_PATH,
+        ttl_seconds: Optional[float] = None,
+        pending_timeout: Optional[float] = None
+    ):
+        """
+        Initialize the Idempotency Store
+
+        Args:
+            path: SQLite file holding the keys (must not be under media/)
+            ttl_seconds: How long a key and its result are kept
+            pending_timeout: Seconds after which an unfinished claim is considered abandoned
+        """
+        self.path = path
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(
+            os.environ.get("STORYBOOK_IDEMPOTENCY_TTL_HOURS", "24")) * 3600
+        self.pending_timeout = pending_timeout if pending_timeout is not None else float(
+            os.environ.get("STORYBOOK_IDEMPOTENCY_PENDING_SECONDS", "600"))
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode; claims take the write lock explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+                        " key TEXT PRIMARY KEY,"
+                        " fingerprint TEXT NOT NULL,"
+                        " state TEXT NOT NULL,"
+                        " result TEXT,"
+                        " updated REAL NOT NULL,"
+                        " expires REAL NOT NULL)"
+                    )
+                    conn.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_expires ON idempotency_keys (expires)")
+                    self._ready = True
+        return conn
+
+    def claim(self, key: str, fingerprint: str) -> Tuple[str, Optional[Dict]]:
+        """
+        Claim a key for a new generation, or find its existing result
+
+        Args:
+            key: Idempotency key
+            fingerprint: request_fingerprint of the request
+
+        Returns:
+            (CLAIMED, None) if the caller must generate, (DONE, result) for a
+            finished request, or (PENDING, None) while another request runs
+
+        Raises:
+            IdempotencyConflict: If the key belongs to a different request
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT fingerprint, state, result, updated, expires FROM idempotency_keys WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is not None:
+                stored_fingerprint, state, result, updated, expires = row
+                stale = expires <= now or (state == PENDING and updated + self.pending_timeout <= now)
+                if not stale:
+                    conn.execute("COMMIT")
+                    if stored_fingerprint != fingerprint:
+                        raise IdempotencyConflict("Idempotency key was already used for a different request")
+                    if state == DONE:
+                        return DONE, json.loads(result)
+                    return PENDING, None
+
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, state, result, updated, expires)"
+                " VALUES (?, ?, ?, NULL, ?, ?)",
+                (key, fingerprint, PENDING, now, now + self.ttl_seconds)
+            )
+            conn.execute("DELETE FROM idempotency_keys WHERE expires <= ?", (now,))
+            conn.execute("COMMIT")
+            return CLAIMED, None
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def complete(self, key: str, result: Dict):
+        """Store the result of a claimed key; it is returned to every retry until it expires"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE idempotency_keys SET state = ?, result = ?, updated = ?, expires = ? WHERE key = ?",
+                (DONE, json.dumps(result), now, now + self.ttl_seconds, key)
+            )
+        finally:
+            conn.close()
+
+    def abandon(self, key: str):
+        """Drop a claim whose generation failed, so the next retry generates again"""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND state = ?", (key, PENDING))
+        finally:
+            conn.close()
+
+
+class IdempotentRunner:
+    def __init__(
+        self,
+        store: IdempotencyStore,
+        wait_timeout: Optional[float] = None,
+        poll_interval: float = 0.5
+    ):
+        """
+        Initialize the Idempotent Runner
+
+        Args:
+            store: IdempotencyStore shared by the workers
+            wait_timeout: Seconds a retry waits for a generation owned by another worker
+            poll_interval: Seconds between store checks while waiting
+        """
+        self.store = store
+        self.wait_timeout = wait_timeout if wait_timeout is not None else float(
+            os.environ.get("STORYBOOK_IDEMPOTENCY_WAIT", "120"))
+        self.poll_interval = poll_interval
+        self.generated_total = 0
+        self.replayed_total = 0
+        self.attached_total = 0
+        self._inflight: Dict[str, Tuple[str, asyncio.Future]] = {}
+
+    async def run(self, key: str, fingerprint: str,
+                  generate: Callable[[], Awaitable[Dict]]) -> Tuple[Dict, bool]:
+        """
+        Run a generation at most once per key
+
+        Args:
+            key: Idempotency key
+            fingerprint: request_fingerprint of the request
+            generate: Coroutine function producing a JSON-serializable result
+
+        Returns:
+            (result, replayed) where replayed is True when the result came from an earlier request
+
+        Raises:
+            IdempotencyConflict: If the key belongs to a different request
+            IdempotencyInProgress: If another worker is still generating after wait_timeout
+        """
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            inflight_fingerprint, inflight_future = inflight
+            if inflight_fingerprint != fingerprint:
+                raise IdempotencyConflict("Idempotency key was already used for a different request")
+            # Same worker: share the running generation's outcome
+            self.attached_total += 1
+            return await asyncio.shield(inflight_future), True
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(_consume_exception)
+        self._inflight[key] = (fingerprint, future)
+        try:
+            result, replayed = await self._claim_and_generate(key, fingerprint, generate)
+            future.set_result(result)
+            return result, replayed
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _claim_and_generate(self, key: str, fingerprint: str,
+                                  generate: Callable[[], Awaitable[Dict]]) -> Tuple[Dict, bool]:
+        deadline = asyncio.get_running_loop().time() + self.wait_timeout
+        waited = False
+
+        while True:
+            state, result = await run_io(self.store.claim, key, fingerprint)
+            if state == DONE:
+                if waited:
+                    self.attached_total += 1
+                else:
+                    self.replayed_total += 1
+                return result, True
+            if state == CLAIMED:
+                break
+
+            # Another worker owns the key; wait for its result, or take over if it is abandoned
+            if asyncio.get_running_loop().time() >= deadline:
+                raise IdempotencyInProgress("The original request is still being generated, please retry shortly")
+            waited = True
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            result = await generate()
+        except BaseException:
+            await run_io(self.store.abandon, key)
+            raise
+
+        await run_io(self.store.complete, key, result)
+        self.generated_total += 1
+        return result, False
+
+    def metrics(self) -> Dict:
+        return {
+            "generated_total": self.generated_total,
+            "replayed_total": self.replayed_total,
+            "attached_total": self.attached_total,
+            "in_flight": len(self._inflight)
+        }
+
+
+def _consume_exception(future: asyncio.Future):
+    # A failure nobody attached to is already raised to the original request
+    if not future.cancelled():
+        future.exception()
+
+
+idempotent_runner = IdempotentRunner(IdempotencyStore())
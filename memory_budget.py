@@ -0,0 +1,265 @@
+"""
+Memory Budget
+Admit generation jobs against a memory budget instead of a fixed concurrency.
+
+Each template's cost is learned from measured peaks: the rise in the RSS of
+this process and the processes it drives (the LibreOffice conversion or pool)
+while a job runs alone. That rise shrinks once the process has grown and kept
+its heap, so learned costs never drop below a floor. A job is admitted when its estimated cost fits in the
+remaining budget. Otherwise it waits in a bounded queue and is shed with
+MemoryBudgetExceeded once the queue is full or the wait times out.
+"""
+
+import asyncio
+import os
+import threading
+from typing import Callable, Dict, Iterator, Optional
+
+from memory_stats import PeakSampler, available_memory_bytes, container_memory_limit_bytes
+
+
+MB = 1024 * 1024
+
+# Learned costs are padded so a slightly heavier name does not overshoot the budget
+COST_HEADROOM = 1.2
+
+
+def job_key(story_id: int, gender: str) -> str:
+    """Key a template's learned cost is stored under"""
+    return f"{story_id}:{gender.lower()}"
+
+
+def default_budget_bytes() -> int:
+    """STORYBOOK_MEMORY_BUDGET_MB, else 75% of the container limit, else 2 GB"""
+    if os.environ.get("STORYBOOK_MEMORY_BUDGET_MB"):
+        return int(os.environ["STORYBOOK_MEMORY_BUDGET_MB"]) * MB
+    limit = container_memory_limit_bytes()
+    if limit is not None:
+        return int(limit * 0.75)
+    return 2048 * MB
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a job cannot be admitted within the memory budget"""
+
+    def __init__(self, message: str, retry_after: int = 5):
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+class Reservation:
+    """Memory held by one admitted job until it is released"""
+
+    def __init__(self, budget: "MemoryBudget", key: str, cost: int):
+        self.budget = budget
+        self.key = key
+        self.cost = cost
+        self._released = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_release_callback(self, callback: Callable[[], None]):
+        """Call callback (from the releasing thread) when the reservation is released"""
+        self._callbacks.append(callback)
+
+    def release(self):
+        """Give the memory back; safe to call from any thread, and more than once"""
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.budget._release(self)
+        for callback in self._callbacks:
+            callback()
+
+
+class MemoryBudget:
+    def __init__(
+        self,
+        budget_bytes: Optional[int] = None,
+        default_cost_bytes: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+        max_queue: Optional[int] = None,
+        min_cost_bytes: Optional[int] = None
+    ):
+        """
+        Initialize the Memory Budget
+
+        Args:
+            budget_bytes: Total memory generation jobs may reserve
+            default_cost_bytes: Cost assumed for a template before it has been measured
+            queue_timeout: Seconds a job may wait for memory before it is shed
+            max_queue: Jobs allowed to wait at once; further jobs are shed immediately
+            min_cost_bytes: Lowest cost a template can learn (default: STORYBOOK_JOB_MEMORY_FLOOR_MB, else default_cost_bytes)
+        """
+        self.budget_bytes = budget_bytes or default_budget_bytes()
+        self.default_cost_bytes = default_cost_bytes or int(os.environ.get("STORYBOOK_JOB_MEMORY_MB", "512")) * MB
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(
+            os.environ.get("STORYBOOK_QUEUE_TIMEOUT", "30"))
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get("STORYBOOK_MAX_QUEUE", "16"))
+        if min_cost_bytes is None and os.environ.get("STORYBOOK_JOB_MEMORY_FLOOR_MB"):
+            min_cost_bytes = int(os.environ["STORYBOOK_JOB_MEMORY_FLOOR_MB"]) * MB
+        self.min_cost_bytes = min_cost_bytes if min_cost_bytes is not None else self.default_cost_bytes
+
+        self.reserved_bytes = 0
+        self.active_jobs = 0
+        self.queued_jobs = 0
+        self.admitted_total = 0
+        self.shed_total = 0
+        self._estimates: Dict[str, int] = {}
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def estimate(self, key: str) -> int:
+        """Expected peak memory of one job for a template key"""
+        with self._lock:
+            return self._estimates.get(key, self.default_cost_bytes)
+
+    def record(self, key: str, peak_bytes: int):
+        """Fold a measured job peak into the template's estimate"""
+        # RSS rises less once the process has grown, so measurements are never trusted below the floor
+        measured = max(int(peak_bytes * COST_HEADROOM), self.min_cost_bytes)
+        with self._lock:
+            previous = self._estimates.get(key)
+            if previous is None:
+                self._estimates[key] = measured
+            else:
+                # Follow the template down slowly when it gets lighter, up at once when it gets heavier
+                self._estimates[key] = max(measured, int(0.8 * previous + 0.2 * measured))
+
+    def _fits(self, cost: int) -> bool:
+        # A job bigger than the whole budget still runs, alone, rather than never
+        if self.active_jobs == 0:
+            return True
+        if self.reserved_bytes + cost > self.budget_bytes:
+            return False
+        available = available_memory_bytes()
+        return available is None or cost <= available
+
+    async def acquire(self, key: str) -> Reservation:
+        """
+        Wait until a job for this template fits in the budget
+
+        Returns:
+            A Reservation to release when the job finishes
+
+        Raises:
+            MemoryBudgetExceeded: If the queue is full or the wait times out
+        """
+        cost = self.estimate(key)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        queued = False
+
+        while True:
+            with self._lock:
+                if self._fits(cost):
+                    self.reserved_bytes += cost
+                    self.active_jobs += 1
+                    self.admitted_total += 1
+                    if queued:
+                        self.queued_jobs -= 1
+                    return Reservation(self, key, cost)
+
+                if not queued:
+                    if self.queued_jobs >= self.max_queue:
+                        self.shed_total += 1
+                        raise MemoryBudgetExceeded("Generation queue is full, please retry shortly")
+                    self.queued_jobs += 1
+                    queued = True
+
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                await asyncio.wait_for(waiter, remaining)
+            except BaseException as e:
+                # Timed out, or the request was cancelled (client gone, shutdown): leave the queue either way
+                timed_out = isinstance(e, asyncio.TimeoutError)
+                with self._lock:
+                    self.queued_jobs -= 1
+                    if timed_out:
+                        self.shed_total += 1
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+                if timed_out:
+                    raise MemoryBudgetExceeded("Timed out waiting for generation capacity, please retry shortly")
+                raise
+
+    def try_acquire(self, key: str) -> Optional[Reservation]:
+        """
+        Reserve memory for a background job without waiting
+
+        Live requests come first: nothing is reserved while any of them is queued.
+
+        Returns:
+            A Reservation, or None when the job does not fit right now
+        """
+        cost = self.estimate(key)
+        with self._lock:
+            if self.queued_jobs > 0 or not self._fits(cost):
+                return None
+            self.reserved_bytes += cost
+            self.active_jobs += 1
+            self.admitted_total += 1
+            return Reservation(self, key, cost)
+
+    def _release(self, reservation: Reservation):
+        with self._lock:
+            self.reserved_bytes -= reservation.cost
+            self.active_jobs -= 1
+            waiters, self._waiters = self._waiters, []
+
+        # Wake every waiter; each re-checks whether it fits now
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def run_measured(self, reservation: Reservation, func: Callable, *args):
+        """
+        Run a job in the current (worker) thread and learn its memory cost
+
+        Only jobs that ran alone, from start to finish, update the estimate,
+        since concurrent jobs share the same process and office processes.
+        """
+        with self._lock:
+            solo = self.active_jobs == 1
+            admitted_before = self.admitted_total
+        sampler = PeakSampler(include_children=True).start()
+        try:
+            return func(*args)
+        finally:
+            peak = sampler.stop()
+            with self._lock:
+                solo = solo and self.active_jobs == 1 and self.admitted_total == admitted_before
+            if solo:
+                self.record(reservation.key, peak)
+
+    def guard_stream(self, reservation: Reservation, stream: Iterator[bytes]) -> Iterator[bytes]:
+        """Hold a reservation for as long as a streamed response is being generated"""
+        try:
+            yield from stream
+        finally:
+            reservation.release()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "reserved_bytes": self.reserved_bytes,
+                "active_jobs": self.active_jobs,
+                "queued_jobs": self.queued_jobs,
+                "admitted_total": self.admitted_total,
+                "shed_total": self.shed_total,
+                "template_cost_bytes": dict(self._estimates)
+            }
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+memory_budget = MemoryBudget()
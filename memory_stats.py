@@ -0,0 +1,220 @@
+"""
+Memory Statistics
+Report the memory footprint of the current process
+"""
+
+import os
+import sys
+import threading
+import tracemalloc
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def _read_proc_kb(path: str, fields) -> Dict[str, int]:
+    """Read 'Field:   123 kB' lines from a /proc file into bytes"""
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in fields:
+                    values[key] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return values
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process in bytes"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss_bytes() -> int:
+    """Current resident set size of this process in bytes (peak RSS where /proc is unavailable)"""
+    status = _read_proc_kb("/proc/self/status", {"VmRSS"})
+    return status.get("VmRSS", peak_rss_bytes())
+
+
+def _child_pids(pid: int) -> List[int]:
+    """Direct children of a process, from /proc/<pid>/task/*/children"""
+    children = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            pass
+    return children
+
+
+def descendants_rss_bytes() -> int:
+    """
+    Current RSS of every process started from this one, e.g. LibreOffice conversions
+    and pooled unoserver instances with their office processes (0 where /proc is unavailable)
+    """
+    total = 0
+    pending = _child_pids(os.getpid())
+    seen = set()
+    while pending:
+        pid = pending.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        total += _read_proc_kb(f"/proc/{pid}/status", {"VmRSS"}).get("VmRSS", 0)
+        pending.extend(_child_pids(pid))
+    return total
+
+
+def available_memory_bytes() -> Optional[int]:
+    """Memory the host can still hand out (MemAvailable), or None when unknown"""
+    return _read_proc_kb("/proc/meminfo", {"MemAvailable"}).get("MemAvailable")
+
+
+def container_memory_limit_bytes() -> Optional[int]:
+    """cgroup memory limit of the container, or None when unlimited or unknown"""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < (1 << 60):
+            return int(value)
+    return None
+
+
+class PeakSampler:
+    """Track how far this process's RSS rises above its starting point while a job runs"""
+
+    def __init__(self, interval: float = 0.05, include_children: bool = False):
+        """
+        Args:
+            interval: Seconds between samples
+            include_children: Also count the RSS of child processes, such as the
+                              LibreOffice conversion the job starts or drives
+        """
+        self.interval = interval
+        self.include_children = include_children
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _measure(self) -> int:
+        if self.include_children:
+            return current_rss_bytes() + descendants_rss_bytes()
+        return current_rss_bytes()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._measure())
+
+    def start(self) -> "PeakSampler":
+        self.baseline = self._measure()
+        self.peak = self.baseline
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> int:
+        """Stop sampling and return the peak rise above the baseline in bytes"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.peak = max(self.peak, self._measure())
+        return self.peak - self.baseline
+
+
+class StageMemorySampler:
+    """
+    Measure the memory one stage of a job uses, whatever ran before it in this process
+
+    An RSS rise shrinks once the process has grown and kept its heap, so it
+    depends on run order. This counts the peak of the Python allocations made
+    during the stage (tracemalloc) plus the peak absolute RSS of child
+    processes, such as the LibreOffice conversion. Memory allocated directly by
+    C libraries (lxml's tree nodes) is not traced. tracemalloc slows allocation
+    down, so this is meant for benchmarks, not live requests.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        """
+        Args:
+            interval: Seconds between child RSS samples
+        """
+        self.interval = interval
+        self.baseline = 0
+        self.children_peak = 0
+        self._owns_tracing = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.children_peak = max(self.children_peak, descendants_rss_bytes())
+
+    def start(self) -> "StageMemorySampler":
+        self._owns_tracing = not tracemalloc.is_tracing()
+        if self._owns_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+        self.children_peak = descendants_rss_bytes()
+        self._thread = threading.Thread(target=self._sample, name="stage-memory-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> int:
+        """Stop sampling and return the stage's peak allocations plus the peak child RSS in bytes"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.children_peak = max(self.children_peak, descendants_rss_bytes())
+        peak = tracemalloc.get_traced_memory()[1]
+        if self._owns_tracing:
+            tracemalloc.stop()
+        return max(0, peak - self.baseline) + self.children_peak
+
+
+def process_memory() -> Dict[str, int]:
+    """
+    Get the memory usage of the current process
+
+    Returns:
+        Dictionary with pid, rss, peak_rss and, on Linux, pss and
+        shared/private byte counts (shared pages such as memory-mapped
+        caches are split across processes in pss)
+    """
+    usage = {
+        "pid": os.getpid(),
+        "peak_rss": peak_rss_bytes()
+    }
+
+    status = _read_proc_kb("/proc/self/status", {"VmRSS"})
+    if "VmRSS" in status:
+        usage["rss"] = status["VmRSS"]
+
+    rollup = _read_proc_kb(
+        "/proc/self/smaps_rollup",
+        {"Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty"}
+    )
+    if rollup:
+        usage["pss"] = rollup.get("Pss", 0)
+        usage["shared"] = rollup.get("Shared_Clean", 0) + rollup.get("Shared_Dirty", 0)
+        usage["private"] = rollup.get("Private_Clean", 0) + rollup.get("Private_Dirty", 0)
+
+    return usage
@@ -0,0 +1,159 @@
+"""
+Output Cache
+Generated storybook artifacts keyed by story, gender, name and template version,
+so a popular name is only generated once per template release
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from artifact_io import write_bytes_atomic
+from storybook_pipeline import generate_storybook, output_filenames
+from template_compiler import bundle_store
+from template_registry import build_replacements, get_template_paths
+
+
+CACHE_ROOT = "media/cache"
+COMPLETE_MARKER = "complete.json"
+
+# Entries from an old template version stay this long after their last hit, so links already handed out keep working
+STALE_GRACE_SECONDS = float(os.environ.get("STORYBOOK_CACHE_STALE_GRACE_HOURS", "24")) * 3600
+
+
+def template_signature(template_path: str) -> str:
+    """Version of a template: its bundle digest when compiled, else its mtime and size"""
+    bundle = bundle_store.get(template_path)
+    if bundle is not None:
+        return bundle.digest
+    stat = os.stat(template_path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class OutputCache:
+    def __init__(self, root: str = CACHE_ROOT):
+        """
+        Initialize the Output Cache
+
+        Args:
+            root: Folder holding one sub-folder per cached storybook (served under /media)
+        """
+        self.root = Path(root)
+
+    def entry_dir(self, story_id: int, gender: str, name: str) -> Path:
+        """Folder a storybook is cached in for the current template versions"""
+        template_path, template_path_cover = get_template_paths(story_id, gender)
+        raw = ":".join([
+            str(story_id), gender.lower(), name,
+            template_signature(template_path), template_signature(template_path_cover)
+        ])
+        key = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:24]
+        return self.root / f"{story_id}_{gender.lower()}" / key
+
+    def lookup(self, story_id: int, gender: str, name: str) -> Optional[Dict[str, str]]:
+        """
+        Get the cached artifacts for a storybook
+
+        Returns:
+            Dictionary of {artifact_key: path}, or None on a miss
+        """
+        try:
+            entry_dir = self.entry_dir(story_id, gender, name)
+        except OSError:
+            return None
+        marker = entry_dir / COMPLETE_MARKER
+        if not marker.exists():
+            return None
+        try:
+            # The marker's mtime records the last hit, which eviction of stale entries goes by
+            os.utime(marker)
+        except OSError:
+            pass
+
+        return {key: str(entry_dir / filename) for key, filename in output_filenames(name).items()}
+
+    def generate(self, story_id: int, gender: str, name: str) -> Dict[str, str]:
+        """
+        Generate a storybook into the cache unless it is already there
+
+        Returns:
+            Dictionary of {artifact_key: path}
+        """
+        cached = self.lookup(story_id, gender, name)
+        if cached is not None:
+            return cached
+
+        template_path, template_path_cover = get_template_paths(story_id, gender)
+        entry_dir = self.entry_dir(story_id, gender, name)
+        entry_dir.parent.mkdir(parents=True, exist_ok=True)
+
+        # The pipeline publishes the artifacts atomically; the marker goes last so a partial entry is never a hit
+        artifacts = generate_storybook(template_path, template_path_cover, build_replacements(name), entry_dir, name)
+        marker = {"story_id": story_id, "gender": gender.lower(), "name": name, "created": time.time()}
+        write_bytes_atomic(entry_dir / COMPLETE_MARKER, json.dumps(marker).encode("utf-8"))
+
+        return artifacts
+
+    def evict_stale(self, grace_seconds: float = STALE_GRACE_SECONDS) -> int:
+        """
+        Delete entries that no longer match the current template versions
+
+        Every deploy or template install changes the cache keys, so the old
+        entries would otherwise never be hit again but still count against the
+        disk budget. Unfinished entries left by a crash are removed as well.
+
+        Args:
+            grace_seconds: Keep a stale entry until it has not been hit for this long
+
+        Returns:
+            Number of entries removed
+        """
+        if not self.root.is_dir():
+            return 0
+
+        now = time.time()
+        removed = 0
+        for group_dir in self.root.iterdir():
+            if not group_dir.is_dir():
+                continue
+            for entry_dir in group_dir.iterdir():
+                if not entry_dir.is_dir():
+                    continue
+                marker = entry_dir / COMPLETE_MARKER
+                try:
+                    if marker.exists():
+                        info = json.loads(marker.read_text(encoding="utf-8"))
+                        if self.entry_dir(info["story_id"], info["gender"], info["name"]) == entry_dir:
+                            continue
+                        last_used = marker.stat().st_mtime
+                    else:
+                        last_used = entry_dir.stat().st_mtime
+                except (OSError, ValueError, KeyError):
+                    # Unreadable marker or missing template: leave the entry alone
+                    continue
+
+                if now - last_used >= grace_seconds:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    removed += 1
+        return removed
+
+    def usage_bytes(self) -> int:
+        """Total size of the cache on disk"""
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+    def entry_bytes(self, artifacts: Dict[str, str]) -> int:
+        return sum(os.path.getsize(path) for path in artifacts.values() if os.path.exists(path))
+
+
+output_cache = OutputCache()
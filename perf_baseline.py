@@ -0,0 +1,230 @@
+"""
+Template Performance Baseline
+Render every registered story/cover template through the full pipeline with a
+fixed set of names, and compare time per stage, output sizes and memory peak
+against a stored per-template baseline.
+
+Usage:
+    python perf_baseline.py --update          # record the baseline
+    python perf_baseline.py                   # check, exit 1 on a regression
+    python perf_baseline.py --threshold 0.1   # allow 10% instead of 20%
+
+Run it on the same kind of machine (and STORYBOOK_CONVERSION_BACKENDS) the
+baseline was recorded on, otherwise the timings are not comparable.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from storybook_pipeline import generate_storybook
+from template_compiler import file_digest
+from template_registry import all_template_keys, build_replacements, get_template_paths
+
+
+BASELINE_FILE = "perf_baseline.json"
+
+# Short, typical, long and non-ASCII names, so text fitting and font fallback are both exercised
+BENCHMARK_NAMES = ["Emma", "Liam", "Olivia", "Maximilian-Alexander", "Zoë"]
+
+DEFAULT_THRESHOLD = 0.2
+
+# Regressions smaller than this are noise, whatever the percentage
+ABSOLUTE_TOLERANCE = {
+    "seconds": 0.05,
+    "bytes": 16 * 1024,
+}
+
+# Stage timings and artifacts that belong to each template of a story/cover pair
+TEMPLATE_PARTS = {
+    "story": {"stages": ["replace_story", "convert_story"], "pptx": "story_pptx", "pdf": "story_pdf"},
+    "cover": {"stages": ["replace_cover", "convert_cover"], "pptx": "cover_pptx", "pdf": "cover_pdf"},
+}
+
+
+def _unit(metric: str) -> str:
+    return "seconds" if metric.endswith("_seconds") else "bytes"
+
+
+def measure_pair(story_id: int, gender: str, names: List[str], work_dir: Path) -> Dict[str, Dict]:
+    """
+    Generate one story/cover pair for every benchmark name
+
+    Args:
+        story_id: Story to render
+        gender: Gender variant to render
+        names: Names to personalize with
+        work_dir: Scratch folder for the generated artifacts
+
+    Returns:
+        Dictionary of {template_path: metrics} for the story and the cover template
+    """
+    template_path, template_path_cover = get_template_paths(story_id, gender)
+    samples = {"story": [], "cover": []}
+
+    for index, name in enumerate(names):
+        timings: Dict[str, float] = {}
+        memory_peaks: Dict[str, int] = {}
+        output_dir = work_dir / f"{story_id}_{gender.lower()}_{index}"
+
+        artifacts = generate_storybook(
+            template_path, template_path_cover, build_replacements(name), output_dir, name, timings, memory_peaks
+        )
+
+        for part, spec in TEMPLATE_PARTS.items():
+            replace_stage, convert_stage = spec["stages"]
+            samples[part].append({
+                "replace_seconds": timings[replace_stage],
+                "convert_seconds": timings[convert_stage],
+                "pptx_bytes": os.path.getsize(artifacts[spec["pptx"]]),
+                "pdf_bytes": os.path.getsize(artifacts[spec["pdf"]]),
+                # Only this template's own stages: their Python allocations plus the LibreOffice RSS
+                "memory_peak_bytes": max(memory_peaks[replace_stage], memory_peaks[convert_stage]),
+            })
+
+    results = {}
+    for part, path in (("story", template_path), ("cover", template_path_cover)):
+        runs = samples[part]
+        results[path] = {
+            "digest": file_digest(path),
+            "metrics": {
+                # Median time is stable against a single slow run; sizes and memory take the worst case
+                "replace_seconds": statistics.median(run["replace_seconds"] for run in runs),
+                "convert_seconds": statistics.median(run["convert_seconds"] for run in runs),
+                "pptx_bytes": max(run["pptx_bytes"] for run in runs),
+                "pdf_bytes": max(run["pdf_bytes"] for run in runs),
+                "memory_peak_bytes": max(run["memory_peak_bytes"] for run in runs),
+            }
+        }
+    return results
+
+
+def run_benchmark(names: List[str] = BENCHMARK_NAMES) -> Dict[str, Dict]:
+    """
+    Measure every registered template
+
+    Returns:
+        Dictionary of {template_path: {"digest": ..., "metrics": {...}}}
+    """
+    results = {}
+    work_dir = Path(tempfile.mkdtemp(prefix="perf_baseline_"))
+    try:
+        # One throwaway run first, so lazy imports and first-use caches are not charged to the first template
+        keys = all_template_keys()
+        if keys:
+            measure_pair(keys[0][0], keys[0][1], names[:1], work_dir / "warm_up")
+
+        for story_id, gender in keys:
+            print(f"⏱️  Story {story_id} ({gender})...")
+            results.update(measure_pair(story_id, gender, names, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(baseline: Dict[str, Dict], current: Dict[str, Dict], threshold: float) -> List[str]:
+    """
+    Find metrics that got worse than the baseline by more than the threshold
+
+    Args:
+        baseline: Stored results
+        current: Fresh results
+        threshold: Allowed relative increase (0.2 = 20%)
+
+    Returns:
+        List of human readable regressions (empty when everything passes)
+    """
+    regressions = []
+    for path, result in current.items():
+        stored = baseline.get(path)
+        if stored is None:
+            print(f"ℹ️  No baseline for {path}, run with --update to record one")
+            continue
+
+        for metric, value in result["metrics"].items():
+            previous = stored["metrics"].get(metric)
+            if previous is None:
+                continue
+            increase = value - previous
+            if increase > previous * threshold and increase > ABSOLUTE_TOLERANCE[_unit(metric)]:
+                change = f"+{increase / previous:.0%}" if previous else "new"
+                regressions.append(f"{path}: {metric} {previous:.6g} -> {value:.6g} ({change})")
+    return regressions
+
+
+def print_report(current: Dict[str, Dict], baseline: Dict[str, Dict]):
+    for path, result in current.items():
+        stored = baseline.get(path, {})
+        changed = " (template changed)" if stored and stored.get("digest") != result["digest"] else ""
+        print(f"\n📄 {path}{changed}")
+        for metric, value in result["metrics"].items():
+            previous = stored.get("metrics", {}).get(metric)
+            if _unit(metric) == "seconds":
+                line = f"{value:.3f}s"
+                if previous is not None:
+                    line += f" (baseline {previous:.3f}s)"
+            else:
+                line = f"{value / 1024:.1f} KB"
+                if previous is not None:
+                    line += f" (baseline {previous / 1024:.1f} KB)"
+            print(f"   - {metric}: {line}")
+
+
+def load_baseline(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, names: List[str], results: Dict[str, Dict]):
+    data = {"names": names, "recorded": time.time(), "templates": results}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check templates against the stored performance baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline JSON file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed relative increase per metric (default: 0.2 = 20%%)")
+    parser.add_argument("--update", action="store_true", help="Record the current results as the new baseline")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    if baseline is not None and baseline.get("names") != BENCHMARK_NAMES:
+        print("⚠️  Baseline was recorded with a different name set, run with --update")
+
+    current = run_benchmark()
+    stored = baseline["templates"] if baseline else {}
+    print_report(current, stored)
+
+    if args.update:
+        save_baseline(args.baseline, BENCHMARK_NAMES, current)
+        print(f"\n💾 Baseline saved to {args.baseline}")
+        return
+
+    if baseline is None:
+        print(f"\n❌ No baseline at {args.baseline}, run with --update first")
+        sys.exit(1)
+
+    regressions = compare(stored, current, args.threshold)
+    if regressions:
+        print(f"\n❌ {len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for regression in regressions:
+            print(f"   - {regression}")
+        sys.exit(1)
+
+    print(f"\n🎉 All templates within {args.threshold:.0%} of the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,20 +5,29 @@ Replace placeholder text like {{CHILD_NAME}} in .pptx files
 
 from pptx import Presentation
 from pathlib import Path
+import io
 import re
-from typing import Dict, List
+from typing import Dict, List, Optional
 import copy
 
 
+
+# Placeholders like {{Child_Name}} or {{CHILD_NAME_UPPER}}
+PLACEHOLDER_PATTERN = re.compile(r'\{\{[A-Za-z0-9_]+\}\}')
+
+
 class PowerPointReplacer:
-    def __init__(self, template_path: str):
+    def __init__(self, template_path: str, personalized_slides: Optional[List[int]] = None):
         """
         Initialize the PowerPoint Replacer
         
         Args:
             template_path: Path to the template .pptx file
+            personalized_slides: 1-based slide numbers that contain placeholders,
+                                 from a compiled template bundle (optional, default: scan all slides)
         """
         self.template_path = Path(template_path)
+        self.personalized_slides = set(personalized_slides) if personalized_slides is not None else None
         if not self.template_path.exists():
             raise FileNotFoundError(f"Template file not found: {template_path}")
     
@@ -27,14 +36,11 @@ class PowerPointReplacer:
         Find all unique placeholders in the presentation
         
         Returns:
-            List of unique placeholder strings (e.g., ['{{CHILD_NAME}}', '{{CHILD_NAME_UPPER}}'])
+            List of unique placeholder strings (e.g., ['{{CHILD_NAME_UPPER}}', '{{Child_Name}}'])
         """
         prs = Presentation(self.template_path)
         placeholders = set()
         
-        # Pattern to match placeholders like {{SOMETHING}}
-        pattern = re.compile(r'\{\{[A-Z_]+\}\}')
-        
         for slide in prs.slides:
             for shape in slide.shapes:
                 if not shape.has_text_frame:
@@ -42,22 +48,20 @@ class PowerPointReplacer:
                 
                 for paragraph in shape.text_frame.paragraphs:
                     for run in paragraph.runs:
-                        matches = pattern.findall(run.text)
+                        matches = PLACEHOLDER_PATTERN.findall(run.text)
                         placeholders.update(matches)
         
         return sorted(list(placeholders))
     
-    def replace_text(self, replacements: Dict[str, str], output_path: str) -> str:
+    def _personalize(self, replacements: Dict[str, str]):
         """
-        Replace text in the PowerPoint file
+        Load the template and apply the replacements in memory
         
         Args:
             replacements: Dictionary of {placeholder: replacement_text}
-                         e.g., {'{{CHILD_NAME}}': 'Emma', '{{CHILD_NAME_UPPER}}': 'EMMA'}
-            output_path: Path where the modified file should be saved
         
         Returns:
-            Path to the output file
+            Tuple of (presentation, total_replacements, slides_modified)
         """
         # Load the presentation
         prs = Presentation(self.template_path)
@@ -68,6 +72,9 @@ class PowerPointReplacer:
         
         # Process each slide
         for slide_num, slide in enumerate(prs.slides, 1):
+            if self.personalized_slides is not None and slide_num not in self.personalized_slides:
+                continue
+            
             slide_modified = False
             
             for shape in slide.shapes:
@@ -95,6 +102,22 @@ class PowerPointReplacer:
             if slide_modified:
                 slides_modified += 1
         
+        return prs, total_replacements, slides_modified
+    
+    def replace_text(self, replacements: Dict[str, str], output_path: str) -> str:
+        """
+        Replace text in the PowerPoint file
+        
+        Args:
+            replacements: Dictionary of {placeholder: replacement_text}
+                         e.g., {'{{CHILD_NAME}}': 'Emma', '{{CHILD_NAME_UPPER}}': 'EMMA'}
+            output_path: Path where the modified file should be saved
+        
+        Returns:
+            Path to the output file
+        """
+        prs, total_replacements, slides_modified = self._personalize(replacements)
+        
         # Save the modified presentation
         output_path = Path(output_path)
         prs.save(str(output_path))
@@ -106,6 +129,27 @@ class PowerPointReplacer:
         
         return str(output_path)
     
+    def replace_text_to_bytes(self, replacements: Dict[str, str]) -> bytes:
+        """
+        Replace text and return the PowerPoint file contents without touching disk
+        
+        Args:
+            replacements: Dictionary of {placeholder: replacement_text}
+        
+        Returns:
+            The personalized .pptx file as bytes
+        """
+        prs, total_replacements, slides_modified = self._personalize(replacements)
+        
+        buffer = io.BytesIO()
+        prs.save(buffer)
+        
+        print(f"✅ Successfully created personalized presentation in memory!")
+        print(f"   - Total replacements: {total_replacements}")
+        print(f"   - Slides modified: {slides_modified}/{len(prs.slides)}")
+        
+        return buffer.getvalue()
+    
     def create_multiple(
         self, 
         names_list: List[Dict[str, str]], 
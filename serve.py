@@ -0,0 +1,65 @@
+"""
+Production Launcher
+Build the shared worker cache once, then run app.py under several uvicorn
+worker processes that all map that cache read-only.
+
+Usage:
+    python serve.py --workers 4 --port 8000
+
+`python app.py` remains the single-process, auto-reloading dev entry point.
+"""
+
+import argparse
+import os
+
+import uvicorn
+
+from shared_cache import ENV_VAR, build_shared_cache
+from slide_preview import SlidePreviewRenderer, snap_width
+from template_compiler import bundle_store
+from template_registry import all_template_paths, build_replacements
+
+
+MEMORY_REPORT_ENV_VAR = "STORYBOOK_MEMORY_REPORT_INTERVAL"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Story Generator API with shared worker caches")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--cache-dir", default="shared_cache",
+                        help="Folder for the memory-mapped preview/story/media cache")
+    parser.add_argument("--media-root", default="media")
+    parser.add_argument("--preview-widths", default="640",
+                        help="Comma-separated preview widths whose base pages are shared by all workers")
+    parser.add_argument("--memory-report-interval", type=int, default=300,
+                        help="Seconds between per-worker memory log lines (0 disables)")
+    args = parser.parse_args()
+
+    # Convert the preview base PDFs once here, so workers only load them instead of each converting on start-up
+    print("🖼️  Preparing preview base pages...")
+    renderer = SlidePreviewRenderer(cache_dir="preview_cache", bundle_store=bundle_store)
+    renderer.warm(all_template_paths(), list(build_replacements("").keys()))
+
+    print("🔧 Building shared cache...")
+    preview_widths = [snap_width(int(width)) for width in args.preview_widths.split(",") if width.strip()]
+    manifest = build_shared_cache(args.cache_dir, args.media_root, renderer, preview_widths)
+    print(f"   - Preview pages: {len(manifest['preview_pages'])}")
+    print(f"   - Saved to: {args.cache_dir}")
+
+    # Workers inherit the environment and map the cache when they import app.py
+    os.environ[ENV_VAR] = os.path.abspath(args.cache_dir)
+    os.environ[MEMORY_REPORT_ENV_VAR] = str(args.memory_report_interval)
+
+    uvicorn.run(
+        "app:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        log_level="info"
+    )
+
+
+if __name__ == "__main__":
+    main()
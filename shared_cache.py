@@ -0,0 +1,260 @@
+"""
+Shared Worker Cache
+Build the preview base rasters, story text tables and the media index once and
+share them read-only across uvicorn worker processes through a memory-mapped file.
+
+The launcher builds the cache before the workers start. Each worker maps the
+same data file, so the OS keeps a single copy of those pages for the host
+instead of one per process. The rasters are the large part: without the cache
+every worker keeps its own decoded copy of each preview page it has served.
+Templates are not included, since python-pptx parses them per request anyway
+and the OS page cache already shares the file bytes.
+"""
+
+import asyncio
+import json
+import mmap
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from PIL import Image
+
+from template_registry import (
+    AVAILABLE_GENDERS,
+    STORY_FUNCTIONS,
+    STORY_IMAGE_FOLDERS,
+    all_template_paths,
+    build_replacements
+)
+
+
+CACHE_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+DATA_FILE = "data.bin"
+ENV_VAR = "STORYBOOK_SHARED_CACHE"
+
+# Stands in for the child's name in the precomputed story text
+NAME_SENTINEL = "\x00CHILD_NAME\x00"
+
+IMAGE_EXTENSIONS = ['.jpeg', '.jpg', '.png']
+IMAGE_PATTERN = re.compile(r'^page_(\d+)_image_(\d+)\.(jpeg|jpg|png)$')
+
+# Rasters are stored as RGBA because Pillow maps that mode without copying
+PREVIEW_MODE = "RGBA"
+
+
+def preview_page_key(base_pdf: str, page_number: int, width: int) -> str:
+    return f"{os.path.abspath(base_pdf)}|{page_number}|{width}"
+
+
+def _index_story_folder(folder: Path) -> Dict[str, List[str]]:
+    """Resolve the image list of every page the same way get_all_page_images does"""
+    filenames = set(os.listdir(folder))
+    pages = set()
+    for filename in filenames:
+        match = IMAGE_PATTERN.match(filename)
+        if match:
+            pages.add(int(match.group(1)))
+
+    index = {}
+    for page_number in sorted(pages):
+        images = []
+        image_index = 1
+        while True:
+            found = None
+            for ext in IMAGE_EXTENSIONS:
+                candidate = f"page_{page_number}_image_{image_index}{ext}"
+                if candidate in filenames:
+                    found = candidate
+                    break
+            if found is None:
+                break
+            images.append(found)
+            image_index += 1
+        if images:
+            index[str(page_number)] = images
+    return index
+
+
+def build_media_index(media_root: str = "media") -> Dict[str, Dict[str, List[str]]]:
+    """
+    Index the story illustration folders
+
+    Args:
+        media_root: Root of the media folder
+
+    Returns:
+        Dictionary of {story_folder: {page_number: [image filenames]}}
+    """
+    index = {}
+    for story_folder in STORY_IMAGE_FOLDERS.values():
+        for gender in AVAILABLE_GENDERS:
+            folder = Path(media_root) / story_folder / gender
+            if folder.is_dir():
+                index[f"{story_folder}/{gender}"] = _index_story_folder(folder)
+    return index
+
+
+def build_story_tables() -> Dict[str, List[str]]:
+    """
+    Render every story once with a name sentinel
+
+    Returns:
+        Dictionary of {"story_id:gender": [page text with NAME_SENTINEL]}
+    """
+    tables = {}
+    for (story_id, gender), story_function in STORY_FUNCTIONS.items():
+        pages = asyncio.run(story_function(NAME_SENTINEL))
+        tables[f"{story_id}:{gender}"] = list(pages)
+    return tables
+
+
+def build_shared_cache(cache_dir: str, media_root: str = "media", preview_renderer=None,
+                       preview_widths: Sequence[int] = ()) -> Dict:
+    """
+    Build the shared cache files
+
+    Args:
+        cache_dir: Folder for the manifest and data file
+        media_root: Root of the media folder
+        preview_renderer: SlidePreviewRenderer whose base pages are rasterized into the cache (optional)
+        preview_widths: Preview widths to rasterize every page at
+
+    Returns:
+        The manifest that was written
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = {"version": CACHE_VERSION, "preview_pages": {}, "sections": {}}
+    data_tmp = cache_dir / f"{DATA_FILE}.tmp"
+    offset = 0
+
+    with open(data_tmp, "wb") as data:
+        def append(payload: bytes) -> Dict[str, int]:
+            nonlocal offset
+            data.write(payload)
+            entry = {"offset": offset, "length": len(payload)}
+            offset += len(payload)
+            return entry
+
+        if preview_renderer is not None:
+            placeholders = list(build_replacements("").keys())
+            for template_path in all_template_paths():
+                if not os.path.exists(template_path):
+                    continue
+                try:
+                    layout = preview_renderer.get_layout(template_path, placeholders)
+                except Exception as e:
+                    print(f"⚠️  Skipping preview pages of {template_path}: {e}")
+                    continue
+                for page_number in range(1, layout.page_count + 1):
+                    for width in preview_widths:
+                        image = preview_renderer.rasterize(layout, page_number, width).convert(PREVIEW_MODE)
+                        entry = append(image.tobytes())
+                        entry.update(width=image.width, height=image.height)
+                        manifest["preview_pages"][preview_page_key(layout.base_pdf, page_number, width)] = entry
+
+        manifest["sections"]["media_index"] = append(
+            json.dumps(build_media_index(media_root)).encode("utf-8"))
+        manifest["sections"]["stories"] = append(
+            json.dumps(build_story_tables()).encode("utf-8"))
+
+    manifest_tmp = cache_dir / f"{MANIFEST_FILE}.tmp"
+    manifest_tmp.write_text(json.dumps(manifest, indent=2))
+
+    # Rename into place so a reader never maps a partially written file
+    os.replace(data_tmp, cache_dir / DATA_FILE)
+    os.replace(manifest_tmp, cache_dir / MANIFEST_FILE)
+
+    return manifest
+
+
+class SharedCache:
+    def __init__(self, cache_dir: str):
+        """
+        Map an existing shared cache read-only
+
+        Args:
+            cache_dir: Folder holding the manifest and data file
+        """
+        self.cache_dir = Path(cache_dir)
+        self.manifest = json.loads((self.cache_dir / MANIFEST_FILE).read_text())
+        if self.manifest.get("version") != CACHE_VERSION:
+            raise ValueError(f"Unsupported shared cache version: {self.manifest.get('version')}")
+
+        with open(self.cache_dir / DATA_FILE, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self._media_index = None
+        self._stories = None
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._map)
+
+    def _section(self, entry: Dict[str, int]) -> memoryview:
+        return self._view[entry["offset"]:entry["offset"] + entry["length"]]
+
+    def _load_json(self, name: str):
+        return json.loads(bytes(self._section(self.manifest["sections"][name])))
+
+    def preview_page(self, base_pdf: str, page_number: int, width: int) -> Optional[Image.Image]:
+        """
+        Get a base page raster straight from the shared mapping
+
+        Returns:
+            A read-only image backed by the mapping, or None if the page was not cached
+        """
+        entry = self.manifest["preview_pages"].get(preview_page_key(base_pdf, page_number, width))
+        if entry is None:
+            return None
+        return Image.frombuffer(
+            PREVIEW_MODE, (entry["width"], entry["height"]), self._section(entry), "raw", PREVIEW_MODE, 0, 1
+        )
+
+    def page_images(self, story_folder: str, page_number: int) -> Optional[List[str]]:
+        """Get the image filenames of a page, or None if the folder is not indexed"""
+        if self._media_index is None:
+            self._media_index = self._load_json("media_index")
+        folder_index = self._media_index.get(story_folder)
+        if folder_index is None:
+            return None
+        return folder_index.get(str(page_number), [f"page_{page_number}_image_1.jpeg"])
+
+    def story_pages(self, story_id: int, gender: str, name: str) -> Optional[List[str]]:
+        """Get the story text for a name, or None if the story is not cached"""
+        if self._stories is None:
+            self._stories = self._load_json("stories")
+        pages = self._stories.get(f"{story_id}:{gender}")
+        if pages is None:
+            return None
+        return [page.replace(NAME_SENTINEL, name) for page in pages]
+
+
+_active_cache: Optional[SharedCache] = None
+
+
+def activate(cache_dir: Optional[str] = None) -> Optional[SharedCache]:
+    """
+    Map the shared cache for this process
+
+    Args:
+        cache_dir: Cache folder, defaults to the STORYBOOK_SHARED_CACHE environment variable
+
+    Returns:
+        The active SharedCache, or None when no cache is configured
+    """
+    global _active_cache
+    cache_dir = cache_dir or os.environ.get(ENV_VAR)
+    if not cache_dir:
+        return None
+    _active_cache = SharedCache(cache_dir)
+    return _active_cache
+
+
+def active_cache() -> Optional[SharedCache]:
+    return _active_cache
+
@@ -0,0 +1,503 @@
+"""
+Slide Preview Renderer
+Fast PNG/WebP previews of personalized storybook pages.
+
+Each template is converted to PDF once with its placeholder text blanked out.
+The pages of that base PDF are rasterized and cached, and at request time
+only the personalized text boxes are drawn on top of the cached base page,
+so a preview never needs its own python-pptx save or office conversion.
+"""
+
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw, ImageFont
+from pptx import Presentation
+from pptx.enum.text import MSO_ANCHOR, PP_ALIGN
+
+from conversion_backends import ConversionRouter, build_router
+from pptx_to_pdf import pptx_to_pdf
+from shared_cache import active_cache
+
+
+EMU_PER_POINT = 12700
+DEFAULT_FONT_SIZE_PT = 18
+SUPPORTED_FORMATS = {"png": "image/png", "webp": "image/webp"}
+
+# Previews are rendered at one of these widths, so arbitrary widths cannot fill the caches
+PREVIEW_WIDTHS = (160, 320, 480, 640, 800, 1200, 1600, 2000)
+
+# Base PDFs are converted by their own engines, never the office pool paid orders use
+PREVIEW_BACKENDS = "powerpoint_com,libreoffice_cli"
+
+MB = 1024 * 1024
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used cache, bounded by entry count and total size"""
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None, sizeof: Optional[Callable] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or len
+        self.size_bytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            self.size_bytes += size - self._sizes.get(key, 0)
+            self._data[key] = value
+            self._sizes[key] = size
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self.size_bytes > self.max_bytes):
+                evicted, _ = self._data.popitem(last=False)
+                self.size_bytes -= self._sizes.pop(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.size_bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TextBox:
+    """A personalized text shape on a slide, positioned in points"""
+
+    def __init__(self, left, top, width, height, paragraphs, font_size, color, align, anchor):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.paragraphs = paragraphs
+        self.font_size = font_size
+        self.color = color
+        self.align = align
+        self.anchor = anchor
+
+    def to_dict(self) -> Dict:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TextBox":
+        data = dict(data)
+        data["color"] = tuple(data["color"])
+        return cls(**data)
+
+
+class TemplateLayout:
+    """Page size, personalized text boxes and base PDF of one template"""
+
+    def __init__(self, slide_width: float, slide_height: float, page_count: int,
+                 boxes: Dict[int, List[TextBox]], base_pdf: str):
+        self.slide_width = slide_width
+        self.slide_height = slide_height
+        self.page_count = page_count
+        self.boxes = boxes
+        self.base_pdf = base_pdf
+
+
+def snap_width(width: int) -> int:
+    """Round a requested width up to the nearest preview width bucket"""
+    for bucket in PREVIEW_WIDTHS:
+        if width <= bucket:
+            return bucket
+    return PREVIEW_WIDTHS[-1]
+
+
+def _image_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def _run_color(run) -> Tuple[int, int, int]:
+    """Get a run's RGB color, defaulting to black for theme/unset colors"""
+    try:
+        rgb = run.font.color.rgb
+    except AttributeError:
+        rgb = None
+    if rgb is None:
+        return (0, 0, 0)
+    return (rgb[0], rgb[1], rgb[2])
+
+
+def _shape_has_placeholder(shape, placeholders: List[str]) -> bool:
+    """Check whether any run of a text shape contains a placeholder"""
+    for paragraph in shape.text_frame.paragraphs:
+        for run in paragraph.runs:
+            if any(placeholder in run.text for placeholder in placeholders):
+                return True
+    return False
+
+
+def _text_box_from_shape(shape) -> TextBox:
+    """Capture position and styling of a text shape"""
+    font_size = None
+    color = (0, 0, 0)
+    align = "left"
+    paragraphs = []
+
+    for paragraph in shape.text_frame.paragraphs:
+        paragraphs.append("".join(run.text for run in paragraph.runs))
+        if paragraph.alignment == PP_ALIGN.CENTER:
+            align = "center"
+        elif paragraph.alignment == PP_ALIGN.RIGHT:
+            align = "right"
+        for run in paragraph.runs:
+            if font_size is None and run.font.size is not None:
+                font_size = run.font.size.pt
+                color = _run_color(run)
+
+    anchor = "top"
+    if shape.text_frame.vertical_anchor == MSO_ANCHOR.MIDDLE:
+        anchor = "middle"
+    elif shape.text_frame.vertical_anchor == MSO_ANCHOR.BOTTOM:
+        anchor = "bottom"
+
+    return TextBox(
+        left=shape.left / EMU_PER_POINT,
+        top=shape.top / EMU_PER_POINT,
+        width=shape.width / EMU_PER_POINT,
+        height=shape.height / EMU_PER_POINT,
+        paragraphs=paragraphs,
+        font_size=font_size or DEFAULT_FONT_SIZE_PT,
+        color=color,
+        align=align,
+        anchor=anchor,
+    )
+
+
+def extract_text_boxes(prs, placeholders: List[str]) -> Dict[int, List[TextBox]]:
+    """
+    Capture the personalized text boxes of a presentation and blank them in place
+
+    Args:
+        prs: Loaded python-pptx Presentation, modified in place
+        placeholders: Placeholder strings that mark personalized text
+
+    Returns:
+        Dictionary of {page_number: [TextBox]}
+    """
+    boxes = {}
+
+    for page_number, slide in enumerate(prs.slides, 1):
+        for shape in slide.shapes:
+            if not shape.has_text_frame:
+                continue
+            if not _shape_has_placeholder(shape, placeholders):
+                continue
+
+            boxes.setdefault(page_number, []).append(_text_box_from_shape(shape))
+
+            # Blank the shape so the base page carries no placeholder text
+            for paragraph in shape.text_frame.paragraphs:
+                for run in paragraph.runs:
+                    run.text = ""
+
+    return boxes
+
+
+class SlidePreviewRenderer:
+    def __init__(self, cache_dir: str = "preview_cache", max_pages: int = 64, max_images: int = 256,
+                 font_path: Optional[str] = None, bundle_store=None,
+                 max_page_bytes: Optional[int] = None, max_image_bytes: Optional[int] = None,
+                 router: Optional[ConversionRouter] = None):
+        """
+        Initialize the Slide Preview Renderer
+
+        Args:
+            cache_dir: Directory holding the blanked templates and base PDFs
+            max_pages: Number of rasterized base pages kept in memory
+            max_images: Number of encoded preview images kept in memory
+            font_path: TrueType font used for the personalized text (optional)
+            bundle_store: BundleStore of compiled templates to take layouts from (optional)
+            max_page_bytes: Memory for rasterized base pages (default: PREVIEW_PAGE_CACHE_MB, 64 MB)
+            max_image_bytes: Memory for encoded preview images (default: PREVIEW_IMAGE_CACHE_MB, 32 MB)
+            router: ConversionRouter for the base PDFs (default: PREVIEW_CONVERSION_BACKENDS, or PREVIEW_BACKENDS)
+        """
+        self.cache_dir = Path(cache_dir)
+        self.bundle_store = bundle_store
+        self.font_path = font_path or os.environ.get("PREVIEW_FONT_PATH")
+        self.router = router or build_router(os.environ.get("PREVIEW_CONVERSION_BACKENDS", PREVIEW_BACKENDS))
+        self._layouts = {}
+        self._layout_locks = {}
+        self._lock = threading.Lock()
+        self._base_pages = LRUCache(
+            max_pages,
+            max_page_bytes or int(os.environ.get("PREVIEW_PAGE_CACHE_MB", "64")) * MB,
+            sizeof=_image_bytes
+        )
+        self._images = LRUCache(
+            max_images,
+            max_image_bytes or int(os.environ.get("PREVIEW_IMAGE_CACHE_MB", "32")) * MB
+        )
+
+    def _template_key(self, template_path: str) -> str:
+        """Cache key that changes whenever the template file changes"""
+        stat = Path(template_path).stat()
+        raw = f"{Path(template_path).resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _build_layout(self, template_path: str, template_key: str, placeholders: List[str]) -> TemplateLayout:
+        """Extract personalized text boxes and convert the blanked template to PDF"""
+        prs = Presentation(template_path)
+        boxes = extract_text_boxes(prs, placeholders)
+
+        work_dir = self.cache_dir / template_key
+        base_pdf = work_dir / "base.pdf"
+        if not base_pdf.exists():
+            work_dir.mkdir(parents=True, exist_ok=True)
+            # Per-process names, renamed into place, so workers converting at once never see a partial file
+            blank_pptx = work_dir / f"base.{os.getpid()}.{threading.get_ident()}.pptx"
+            partial_pdf = blank_pptx.with_suffix(".pdf")
+            try:
+                prs.save(str(blank_pptx))
+                pptx_to_pdf(str(blank_pptx), str(partial_pdf), router=self.router)
+                os.replace(partial_pdf, base_pdf)
+            finally:
+                blank_pptx.unlink(missing_ok=True)
+                partial_pdf.unlink(missing_ok=True)
+
+        return TemplateLayout(
+            slide_width=prs.slide_width / EMU_PER_POINT,
+            slide_height=prs.slide_height / EMU_PER_POINT,
+            page_count=len(prs.slides),
+            boxes=boxes,
+            base_pdf=str(base_pdf),
+        )
+
+    def _bundle_layout(self, bundle) -> TemplateLayout:
+        """Layout straight from a compiled template bundle, no conversion needed"""
+        return TemplateLayout(
+            slide_width=bundle.slide_width,
+            slide_height=bundle.slide_height,
+            page_count=bundle.page_count,
+            boxes=bundle.text_boxes(),
+            base_pdf=bundle.base_pdf,
+        )
+
+    def get_layout(self, template_path: str, placeholders: List[str]) -> TemplateLayout:
+        """
+        Get the cached layout of a template, building it on first use
+
+        Args:
+            template_path: Path to the template .pptx file
+            placeholders: Placeholder strings that mark personalized text
+
+        Returns:
+            TemplateLayout for the template
+        """
+        if self.bundle_store is not None:
+            bundle = self.bundle_store.get(template_path)
+            if bundle is not None:
+                with self._lock:
+                    layout = self._layouts.get(bundle.digest)
+                    if layout is None:
+                        layout = self._bundle_layout(bundle)
+                        self._layouts[bundle.digest] = layout
+                return layout
+
+        template_key = self._template_key(template_path)
+
+        with self._lock:
+            layout = self._layouts.get(template_key)
+            if layout is not None:
+                return layout
+            build_lock = self._layout_locks.setdefault(template_key, threading.Lock())
+
+        # Only one thread converts a given template; the others wait for it
+        with build_lock:
+            with self._lock:
+                layout = self._layouts.get(template_key)
+            if layout is None:
+                layout = self._build_layout(template_path, template_key, placeholders)
+                with self._lock:
+                    self._layouts[template_key] = layout
+        return layout
+
+    def rasterize(self, layout: TemplateLayout, page_number: int, width: int) -> Image.Image:
+        """Rasterize a page of the base PDF at the given width"""
+        with fitz.open(layout.base_pdf) as doc:
+            page = doc[page_number - 1]
+            zoom = width / page.rect.width
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+    def _base_page(self, layout: TemplateLayout, page_number: int, width: int) -> Image.Image:
+        """Get a base page raster: from the shared worker cache, the local LRU, or rendered now"""
+        shared = active_cache()
+        if shared is not None:
+            image = shared.preview_page(layout.base_pdf, page_number, width)
+            if image is not None:
+                return image
+
+        cache_key = (layout.base_pdf, page_number, width)
+        image = self._base_pages.get(cache_key)
+        if image is not None:
+            return image
+
+        image = self.rasterize(layout, page_number, width)
+        self._base_pages.put(cache_key, image)
+        return image
+
+    def _font(self, size_px: int):
+        if self.font_path:
+            return ImageFont.truetype(self.font_path, size_px)
+        return ImageFont.load_default(size=size_px)
+
+    def _wrap(self, draw: ImageDraw.ImageDraw, text: str, font, max_width: float) -> List[str]:
+        """Greedy word wrap of a paragraph to the box width"""
+        lines = []
+        current = ""
+        for word in text.split():
+            candidate = f"{current} {word}".strip()
+            if current and draw.textlength(candidate, font=font) > max_width:
+                lines.append(current)
+                current = word
+            else:
+                current = candidate
+        lines.append(current)
+        return lines
+
+    def _draw_box(self, draw: ImageDraw.ImageDraw, box: TextBox, replacements: Dict[str, str], scale: float):
+        font_px = max(1, int(round(box.font_size * scale)))
+        font = self._font(font_px)
+        line_height = int(round(font_px * 1.2))
+        left = box.left * scale
+        top = box.top * scale
+        width = box.width * scale
+        height = box.height * scale
+
+        lines = []
+        for paragraph in box.paragraphs:
+            for placeholder, replacement in replacements.items():
+                paragraph = paragraph.replace(placeholder, replacement)
+            lines.extend(self._wrap(draw, paragraph, font, width))
+
+        text_height = line_height * len(lines)
+        if box.anchor == "middle":
+            y = top + (height - text_height) / 2
+        elif box.anchor == "bottom":
+            y = top + height - text_height
+        else:
+            y = top
+
+        for line in lines:
+            line_width = draw.textlength(line, font=font)
+            if box.align == "center":
+                x = left + (width - line_width) / 2
+            elif box.align == "right":
+                x = left + width - line_width
+            else:
+                x = left
+            draw.text((x, y), line, font=font, fill=box.color)
+            y += line_height
+
+    def render_page(
+        self,
+        template_path: str,
+        page_number: int,
+        replacements: Dict[str, str],
+        width: int = 600,
+        image_format: str = "png"
+    ) -> bytes:
+        """
+        Render a personalized preview of one page
+
+        Args:
+            template_path: Path to the template .pptx file
+            page_number: 1-based page (slide) number
+            replacements: Dictionary of {placeholder: replacement_text}
+            width: Requested image width in pixels, rounded up to a PREVIEW_WIDTHS bucket
+            image_format: 'png' or 'webp'
+
+        Returns:
+            Encoded image bytes
+
+        Raises:
+            ValueError: If the page number or format is invalid
+        """
+        image_format = image_format.lower()
+        if image_format not in SUPPORTED_FORMATS:
+            raise ValueError(f"Unsupported preview format: {image_format}")
+
+        width = snap_width(width)
+        layout = self.get_layout(template_path, list(replacements.keys()))
+        if page_number < 1 or page_number > layout.page_count:
+            raise ValueError(f"Page {page_number} out of range (1-{layout.page_count})")
+
+        cache_key = (
+            layout.base_pdf, page_number, width, image_format,
+            tuple(sorted(replacements.items()))
+        )
+        cached = self._images.get(cache_key)
+        if cached is not None:
+            return cached
+
+        base = self._base_page(layout, page_number, width)
+        boxes = layout.boxes.get(page_number, [])
+        if boxes:
+            image = base.convert("RGB") if base.mode != "RGB" else base.copy()
+            draw = ImageDraw.Draw(image)
+            scale = width / layout.slide_width
+            for box in boxes:
+                self._draw_box(draw, box, replacements, scale)
+        else:
+            # Untouched page: the cached base raster is the preview
+            image = base.convert("RGB") if base.mode != "RGB" else base
+
+        buffer = io.BytesIO()
+        if image_format == "webp":
+            image.save(buffer, format="WEBP", quality=80, method=0)
+        else:
+            image.save(buffer, format="PNG", compress_level=1)
+        data = buffer.getvalue()
+
+        self._images.put(cache_key, data)
+        return data
+
+    def has_base_pdf(self, template_path: str) -> bool:
+        """Whether the template's base PDF exists, from a compiled bundle or an earlier conversion"""
+        if self.bundle_store is not None and self.bundle_store.get(template_path) is not None:
+            return True
+        return (self.cache_dir / self._template_key(template_path) / "base.pdf").exists()
+
+    def warm(self, template_paths: List[str], placeholders: List[str], convert: bool = True):
+        """
+        Build layouts ahead of the first preview request
+
+        Args:
+            template_paths: Templates to prepare
+            placeholders: Placeholder strings that mark personalized text
+            convert: Also convert templates that have no base PDF yet; when False
+                only the existing base PDFs are loaded
+        """
+        for template_path in template_paths:
+            if not os.path.exists(template_path):
+                continue
+            if not convert and not self.has_base_pdf(template_path):
+                continue
+            try:
+                self.get_layout(template_path, placeholders)
+            except Exception as e:
+                print(f"❌ Preview warm-up failed for {template_path}: {e}")
@@ -0,0 +1,269 @@
+"""
+Storybook Pipeline
+Personalize the story and cover templates and convert them to PDF,
+either into an output folder or as a stream of bytes for the response
+"""
+
+import shutil
+import time
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from artifact_io import FsyncBatch, make_staging_dir, publish_dir, write_bytes
+from memory_stats import StageMemorySampler
+from pptx_replacer import PowerPointReplacer
+from pptx_to_pdf import pptx_to_pdf
+from template_compiler import bundle_store
+
+
+CHUNK_SIZE = 64 * 1024
+
+STREAM_MEDIA_TYPES = {
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "pdf": "application/pdf",
+    "zip": "application/zip"
+}
+
+# Files a streamed delivery leaves under output_dir when persisted
+PERSISTED_ARTIFACTS = {
+    "pptx": ["story_pptx"],
+    "pdf": ["story_pptx", "story_pdf"],
+    "zip": ["story_pptx", "cover_pptx", "story_pdf", "cover_pdf"]
+}
+
+
+def output_filenames(name: str) -> Dict[str, str]:
+    """
+    Get the artifact filenames for a child's name
+
+    Args:
+        name: The character name used in the story
+
+    Returns:
+        Dictionary of {artifact_key: filename}
+    """
+    return {
+        "story_pptx": f"{name}_Storybook.pptx",
+        "cover_pptx": f"{name}_cover_Storybook.pptx",
+        "story_pdf": f"{name}_Storybook.pdf",
+        "cover_pdf": f"{name}_cover_Storybook.pdf"
+    }
+
+
+def _replacer(template_path: str) -> PowerPointReplacer:
+    """Replacer that only visits the personalized slides when a compiled bundle is active"""
+    bundle = bundle_store.get(template_path)
+    return PowerPointReplacer(template_path, bundle.personalized_slides if bundle else None)
+
+
+def _convert(pptx_path: str, template_path: str, replacements: Dict[str, str]) -> str:
+    """Convert to PDF, letting the router use the template's compiled bundle when there is one"""
+    return pptx_to_pdf(pptx_path, bundle=bundle_store.get(template_path), replacements=replacements)
+
+
+def generate_storybook(
+    template_path: str,
+    template_path_cover: str,
+    replacements: Dict[str, str],
+    output_dir: Path,
+    name: str,
+    timings: Optional[Dict[str, float]] = None,
+    memory_peaks: Optional[Dict[str, int]] = None
+) -> Dict[str, str]:
+    """
+    Generate all four artifacts into an output folder
+
+    Args:
+        template_path: Path to the story template .pptx
+        template_path_cover: Path to the cover template .pptx
+        replacements: Dictionary of {placeholder: replacement_text}
+        output_dir: Folder the artifacts are written to
+        name: The character name, used for the filenames
+        timings: Dictionary filled with seconds per stage (optional)
+        memory_peaks: Dictionary filled with the memory each stage uses, LibreOffice included,
+                      measured with StageMemorySampler (optional, slows the job down)
+
+    Returns:
+        Dictionary of {artifact_key: path}
+    """
+    filenames = output_filenames(name)
+    output_dir = Path(output_dir)
+    timings = timings if timings is not None else {}
+    stage_started = time.perf_counter()
+    sampler = StageMemorySampler().start() if memory_peaks is not None else None
+
+    def end_stage(stage: str):
+        nonlocal stage_started, sampler
+        now = time.perf_counter()
+        timings[stage] = now - stage_started
+        stage_started = now
+        if sampler is not None:
+            memory_peaks[stage] = sampler.stop()
+            sampler = StageMemorySampler().start()
+
+    # Build everything in a private staging folder; nothing shows up under media/ until it is complete
+    staging_dir = make_staging_dir()
+    batch = FsyncBatch()
+    try:
+        # Replace text and save
+        story_pptx = write_bytes(
+            staging_dir / filenames["story_pptx"],
+            _replacer(template_path).replace_text_to_bytes(replacements),
+            batch
+        )
+        end_stage("replace_story")
+        cover_pptx = write_bytes(
+            staging_dir / filenames["cover_pptx"],
+            _replacer(template_path_cover).replace_text_to_bytes(replacements),
+            batch
+        )
+        end_stage("replace_cover")
+
+        # Convert pptx to pdf
+        batch.add(_convert(story_pptx, template_path, replacements))
+        end_stage("convert_story")
+        batch.add(_convert(cover_pptx, template_path_cover, replacements))
+        end_stage("convert_cover")
+
+        publish_dir(staging_dir, output_dir, batch)
+        end_stage("publish")
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return {key: str(output_dir / filename) for key, filename in filenames.items()}
+
+
+def iter_bytes(data: bytes, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield an in-memory buffer in chunks"""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield bytes(view[start:start + chunk_size])
+
+
+def iter_file(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield a file's contents in chunks"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that collects bytes for a generator to drain"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries: Iterable[Tuple[str, Callable[[], Iterable[bytes]]]]) -> Iterator[bytes]:
+    """
+    Stream a ZIP archive while its entries are still being produced
+
+    Args:
+        entries: Iterable of (arcname, factory) where factory is called lazily
+                 and returns the entry's content chunks
+
+    Returns:
+        Iterator over the archive bytes
+    """
+    sink = _ChunkSink()
+    # Artifacts are already compressed (PPTX) or mostly images (PDF), so store them
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for arcname, factory in entries:
+            with archive.open(arcname, mode="w", force_zip64=True) as entry:
+                for chunk in factory():
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # Central directory
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def stream_storybook(
+    template_path: str,
+    template_path_cover: str,
+    replacements: Dict[str, str],
+    output_dir: Path,
+    name: str,
+    artifact: str,
+    persist: bool = True
+) -> Iterator[bytes]:
+    """
+    Generate the storybook and stream the requested artifact as it is produced
+
+    Args:
+        template_path: Path to the story template .pptx
+        template_path_cover: Path to the cover template .pptx
+        replacements: Dictionary of {placeholder: replacement_text}
+        output_dir: Folder the persisted copies are published to (used when persist is True)
+        name: The character name, used for the filenames
+        artifact: 'pptx' (story PPTX), 'pdf' (story PDF) or 'zip' (all four)
+        persist: Keep copies under output_dir so they stay downloadable with range requests;
+                 PERSISTED_ARTIFACTS lists which files that leaves for each artifact
+
+    Returns:
+        Iterator over the response bytes
+    """
+    if artifact not in STREAM_MEDIA_TYPES:
+        raise ValueError(f"Unsupported artifact: {artifact}")
+
+    filenames = output_filenames(name)
+
+    # Artifacts are staged privately and, when persisted, published to output_dir once complete
+    staging_dir = make_staging_dir()
+    batch = FsyncBatch()
+
+    def pptx_bytes(key: str, template: str) -> bytes:
+        data = _replacer(template).replace_text_to_bytes(replacements)
+        # PDF and ZIP deliveries convert from disk, plain PPTX streams straight from memory
+        if persist or artifact != "pptx":
+            write_bytes(staging_dir / filenames[key], data, batch)
+        return data
+
+    def pdf_path(pptx_key: str, template: str) -> str:
+        path = _convert(str(staging_dir / filenames[pptx_key]), template, replacements)
+        batch.add(path)
+        return path
+
+    try:
+        if artifact == "pptx":
+            yield from iter_bytes(pptx_bytes("story_pptx", template_path))
+        elif artifact == "pdf":
+            pptx_bytes("story_pptx", template_path)
+            yield from iter_file(pdf_path("story_pptx", template_path))
+        else:
+            entries: List[Tuple[str, Callable[[], Iterable[bytes]]]] = [
+                (filenames["story_pptx"], lambda: iter_bytes(pptx_bytes("story_pptx", template_path))),
+                (filenames["cover_pptx"], lambda: iter_bytes(pptx_bytes("cover_pptx", template_path_cover))),
+                (filenames["story_pdf"], lambda: iter_file(pdf_path("story_pptx", template_path))),
+                (filenames["cover_pdf"], lambda: iter_file(pdf_path("cover_pptx", template_path_cover)))
+            ]
+            yield from stream_zip(entries)
+
+        if persist:
+            publish_dir(staging_dir, output_dir, batch)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
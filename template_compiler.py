@@ -0,0 +1,432 @@
+"""
+Template Compiler
+Validate a storybook PPTX and compile it into a bundle holding everything the
+request path would otherwise re-derive: the placeholder map, the personalized
+slides, the preview text boxes, a pre-rendered base PDF and a content digest.
+
+Bundle layout:
+    compiled_templates/<template stem>/<digest>/manifest.json
+    compiled_templates/<template stem>/<digest>/template.pptx
+    compiled_templates/<template stem>/<digest>/base.pdf
+    compiled_templates/<template stem>/current.json   -> active digest
+
+Usage:
+    python template_compiler.py new_template.pptx --story-id 1 --gender male --part story
+    python template_compiler.py --all
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from pptx import Presentation
+
+from pptx_replacer import PLACEHOLDER_PATTERN
+from pptx_to_pdf import pptx_to_pdf
+from slide_preview import EMU_PER_POINT, TextBox, extract_text_boxes
+from template_registry import TEMPLATE_COVER_MAPPING, TEMPLATE_MAPPING, build_replacements, get_template_paths
+
+
+BUNDLE_ROOT = "compiled_templates"
+BUNDLE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "current.json"
+
+
+class TemplateValidationError(ValueError):
+    """Raised when a template cannot be personalized correctly"""
+
+    def __init__(self, problems: List[str]):
+        self.problems = problems
+        super().__init__("; ".join(problems))
+
+
+def known_placeholders() -> List[str]:
+    """Placeholders the generation pipeline knows how to fill"""
+    return list(build_replacements("").keys())
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def validate_template(prs) -> Dict[str, List[int]]:
+    """
+    Check that every placeholder in a presentation will be replaced
+
+    Args:
+        prs: Loaded python-pptx Presentation
+
+    Returns:
+        Placeholder map of {placeholder: [1-based slide numbers]}
+
+    Raises:
+        TemplateValidationError: If placeholders are unknown, split across runs, or missing
+    """
+    known = known_placeholders()
+    placeholder_map = {}
+    problems = []
+
+    for slide_num, slide in enumerate(prs.slides, 1):
+        for shape in slide.shapes:
+            if not shape.has_text_frame:
+                continue
+
+            run_matches = set()
+            for paragraph in shape.text_frame.paragraphs:
+                for run in paragraph.runs:
+                    run_matches.update(PLACEHOLDER_PATTERN.findall(run.text))
+
+            # Replacement works run by run, so a placeholder split by formatting is never filled
+            for placeholder in set(PLACEHOLDER_PATTERN.findall(shape.text_frame.text)) - run_matches:
+                problems.append(
+                    f"Slide {slide_num}: {placeholder} is split across text runs; "
+                    f"retype it with a single formatting"
+                )
+
+            for placeholder in run_matches:
+                if placeholder not in known:
+                    hint = [p for p in known if p.lower() == placeholder.lower()]
+                    suggestion = f" (did you mean {hint[0]}?)" if hint else ""
+                    problems.append(f"Slide {slide_num}: unknown placeholder {placeholder}{suggestion}")
+                    continue
+                slides = placeholder_map.setdefault(placeholder, [])
+                if slide_num not in slides:
+                    slides.append(slide_num)
+
+    if not placeholder_map and not problems:
+        problems.append(f"No placeholders found; expected at least one of {', '.join(known)}")
+
+    if problems:
+        raise TemplateValidationError(problems)
+
+    return placeholder_map
+
+
+class TemplateBundle:
+    def __init__(self, directory: str, manifest: Dict):
+        """
+        A compiled template bundle on disk
+
+        Args:
+            directory: Bundle folder
+            manifest: Parsed manifest.json
+        """
+        self.directory = Path(directory)
+        self.manifest = manifest
+        self.digest = manifest["digest"]
+        self.placeholder_map = manifest["placeholder_map"]
+        self.personalized_slides = manifest["personalized_slides"]
+        self.page_count = manifest["page_count"]
+        self.slide_width = manifest["slide_width"]
+        self.slide_height = manifest["slide_height"]
+        self.template_pptx = str(self.directory / "template.pptx")
+        self.base_pdf = str(self.directory / "base.pdf")
+
+    @classmethod
+    def load(cls, directory: str) -> "TemplateBundle":
+        manifest = json.loads((Path(directory) / MANIFEST_FILE).read_text())
+        if manifest.get("version") != BUNDLE_VERSION:
+            raise ValueError(f"Unsupported bundle version: {manifest.get('version')}")
+        return cls(directory, manifest)
+
+    def text_boxes(self) -> Dict[int, List[TextBox]]:
+        return {
+            int(page): [TextBox.from_dict(box) for box in boxes]
+            for page, boxes in self.manifest["text_boxes"].items()
+        }
+
+    def summary(self) -> Dict:
+        return {
+            "digest": self.digest,
+            "source": self.manifest["source"],
+            "page_count": self.page_count,
+            "placeholder_map": self.placeholder_map,
+            "personalized_slides": self.personalized_slides
+        }
+
+
+def _bundle_dir(template_path: str, root: str = BUNDLE_ROOT) -> Path:
+    return Path(root) / Path(template_path).stem
+
+
+def compile_template(source_path: str, template_path: str, root: str = BUNDLE_ROOT) -> TemplateBundle:
+    """
+    Validate a PPTX and compile it into a bundle for a registered template
+
+    Args:
+        source_path: The PPTX to compile
+        template_path: Registered template path the bundle is for
+        root: Root folder for compiled bundles
+
+    Returns:
+        The compiled TemplateBundle (reused if this content was compiled before)
+
+    Raises:
+        TemplateValidationError: If the template fails validation
+    """
+    digest = file_digest(source_path)
+    bundle_dir = _bundle_dir(template_path, root) / digest[:16]
+    if (bundle_dir / MANIFEST_FILE).exists():
+        return TemplateBundle.load(bundle_dir)
+
+    prs = Presentation(source_path)
+    placeholder_map = validate_template(prs)
+    page_count = len(prs.slides)
+    boxes = extract_text_boxes(prs, known_placeholders())
+
+    bundle_dir.parent.mkdir(parents=True, exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(prefix=".compile_", dir=bundle_dir.parent))
+    try:
+        shutil.copyfile(source_path, work_dir / "template.pptx")
+
+        # Pre-render the static pages once; the preview draws names on top of these
+        prs.save(str(work_dir / "base.pptx"))
+        pptx_to_pdf(str(work_dir / "base.pptx"), str(work_dir / "base.pdf"))
+        os.remove(work_dir / "base.pptx")
+
+        manifest = {
+            "version": BUNDLE_VERSION,
+            "digest": digest,
+            "source": Path(source_path).name,
+            "template_path": Path(template_path).as_posix(),
+            "page_count": page_count,
+            "slide_width": prs.slide_width / EMU_PER_POINT,
+            "slide_height": prs.slide_height / EMU_PER_POINT,
+            "placeholder_map": placeholder_map,
+            "personalized_slides": sorted({s for slides in placeholder_map.values() for s in slides}),
+            "text_boxes": {
+                str(page): [box.to_dict() for box in page_boxes]
+                for page, page_boxes in boxes.items()
+            }
+        }
+        (work_dir / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+
+        # A finished bundle appears in one rename; a concurrent compile of the same content wins harmlessly
+        try:
+            os.rename(work_dir, bundle_dir)
+        except OSError:
+            if not (bundle_dir / MANIFEST_FILE).exists():
+                raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"✅ Compiled template bundle {digest[:16]} for {template_path}")
+    return TemplateBundle.load(bundle_dir)
+
+
+def _signature(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _temp_path(path: Path) -> Path:
+    # Unique per writer, in the target's folder so the final os.replace stays on one filesystem
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    os.close(fd)
+    return Path(tmp)
+
+
+def _atomic_write_text(path: Path, text: str):
+    tmp = _temp_path(path)
+    try:
+        tmp.write_text(text)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+_install_locks: Dict[str, threading.Lock] = {}
+_install_locks_guard = threading.Lock()
+
+
+@contextmanager
+def template_install_lock(template_path: str, root: str = BUNDLE_ROOT):
+    """
+    Serialize compiling and installing one template across threads and worker processes
+
+    Without it, two uploads of the same template can interleave so the installed
+    file and current.json end up pointing at different bundles.
+    """
+    lock_dir = _bundle_dir(template_path, root)
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with _install_locks_guard:
+        thread_lock = _install_locks.setdefault(str(lock_dir.resolve()), threading.Lock())
+
+    with thread_lock, open(lock_dir / ".install.lock", "w") as lock_file:
+        if sys.platform != "win32":
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+class BundleStore:
+    def __init__(self, root: str = BUNDLE_ROOT):
+        """
+        Serve the active compiled bundle of each registered template
+
+        Args:
+            root: Root folder for compiled bundles
+        """
+        self.root = root
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    def _load_current(self, template_path: str) -> Optional[Dict]:
+        pointer = _bundle_dir(template_path, self.root) / CURRENT_FILE
+        try:
+            current = json.loads(pointer.read_text())
+            current["bundle"] = TemplateBundle.load(_bundle_dir(template_path, self.root) / current["digest"][:16])
+        except (OSError, ValueError, KeyError):
+            return None
+        return current
+
+    def get(self, template_path: str) -> Optional[TemplateBundle]:
+        """
+        Get the active bundle for a template path
+
+        Returns:
+            The bundle, or None when the template has no bundle or the installed
+            file no longer matches it (edited by hand, or swapped by another process)
+        """
+        key = Path(template_path).as_posix()
+        try:
+            signature = _signature(template_path)
+        except OSError:
+            return None
+
+        with self._lock:
+            current = self._bundles.get(key)
+        if current is None or current["signature"] != signature:
+            # Another worker may have installed a new bundle; re-read the pointer once
+            current = self._load_current(template_path)
+            if current is None or current["signature"] != signature:
+                return None
+            with self._lock:
+                self._bundles[key] = current
+        return current["bundle"]
+
+    def install(self, bundle: TemplateBundle, template_path: str):
+        """
+        Atomically make a bundle the live version of a registered template
+
+        Args:
+            bundle: Compiled TemplateBundle
+            template_path: Registered template path to replace
+
+        Callers replacing a live template hold template_install_lock around compile and install.
+        """
+        template = Path(template_path)
+        template.parent.mkdir(parents=True, exist_ok=True)
+
+        # Copy next to the target and rename over it, so readers see the old or new file, never a partial one
+        tmp = _temp_path(template)
+        try:
+            shutil.copyfile(bundle.template_pptx, tmp)
+            os.replace(tmp, template)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+        current = {"digest": bundle.digest, "signature": _signature(template_path)}
+        _atomic_write_text(_bundle_dir(template_path, self.root) / CURRENT_FILE, json.dumps(current, indent=2))
+
+        current["bundle"] = bundle
+        with self._lock:
+            self._bundles[template.as_posix()] = current
+
+        print(f"✅ Installed bundle {bundle.digest[:16]} as {template_path}")
+
+
+# Process-wide store used by the pipeline and the preview renderer
+bundle_store = BundleStore()
+
+
+def compile_and_install(source_path: str, story_id: int, gender: str, part: str,
+                        store: BundleStore = bundle_store) -> TemplateBundle:
+    """
+    Validate, compile and hot-swap a template for a story/gender/part
+
+    Args:
+        source_path: The new PPTX
+        story_id: The story identifier
+        gender: The gender (male or female)
+        part: 'story' or 'cover'
+        store: BundleStore to install into
+
+    Returns:
+        The installed TemplateBundle
+    """
+    template_path, template_path_cover = get_template_paths(story_id, gender)
+    target = template_path_cover if part == "cover" else template_path
+    if not target:
+        raise ValueError(f"No template registered for story_id={story_id}, gender={gender}, part={part}")
+
+    # The last upload to finish is the one that stays live, with a matching current.json
+    with template_install_lock(target, store.root):
+        bundle = compile_template(source_path, target, store.root)
+        store.install(bundle, target)
+    return bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and compile storybook templates")
+    parser.add_argument("source", nargs="?", help="PPTX to compile")
+    parser.add_argument("--story-id", type=int)
+    parser.add_argument("--gender", choices=["male", "female"])
+    parser.add_argument("--part", choices=["story", "cover"], default="story")
+    parser.add_argument("--check", action="store_true", help="Only validate, do not compile")
+    parser.add_argument("--all", action="store_true", help="Compile every registered template in place")
+    args = parser.parse_args()
+
+    try:
+        if args.all:
+            for template_path in list(TEMPLATE_MAPPING.values()) + list(TEMPLATE_COVER_MAPPING.values()):
+                if not os.path.exists(template_path):
+                    print(f"❌ Missing: {template_path}")
+                    continue
+                if args.check:
+                    validate_template(Presentation(template_path))
+                    print(f"✅ Valid: {template_path}")
+                else:
+                    with template_install_lock(template_path):
+                        bundle = compile_template(template_path, template_path)
+                        bundle_store.install(bundle, template_path)
+            return
+
+        if not args.source:
+            parser.error("source is required unless --all is given")
+
+        if args.check:
+            placeholder_map = validate_template(Presentation(args.source))
+            print(f"✅ Valid: {args.source}")
+            print(f"   - Placeholders: {placeholder_map}")
+            return
+
+        if args.story_id is None or args.gender is None:
+            parser.error("--story-id and --gender are required to install a template")
+
+        bundle = compile_and_install(args.source, args.story_id, args.gender, args.part)
+        print(json.dumps(bundle.summary(), indent=2))
+
+    except TemplateValidationError as e:
+        print("❌ Template validation failed:")
+        for problem in e.problems:
+            print(f"   - {problem}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
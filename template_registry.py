@@ -0,0 +1,82 @@
+"""
+Template Registry
+Single place that maps (story_id, gender) to the storybook PPTX templates
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from stroy_one import story_female_one, story_male_one
+from stroy_two import story_female_two, story_male_two
+
+
+AVAILABLE_STORIES = [1, 2]
+AVAILABLE_GENDERS = ["male", "female"]
+
+# Story text functions and their illustration folders under media/
+STORY_FUNCTIONS = {
+    (1, "male"): story_male_one,
+    (1, "female"): story_female_one,
+    (2, "male"): story_male_two,
+    (2, "female"): story_female_two
+}
+
+STORY_IMAGE_FOLDERS = {
+    1: "store_one",
+    2: "store_two"
+}
+
+# Map story_id and gender to template files
+TEMPLATE_MAPPING = {
+    (1, "male"): "story_book/Storybook_Template_1_male.pptx",
+    (1, "female"): "story_book/Storybook_Template_1_female.pptx",
+    (2, "male"): "story_book/Storybook_Template_2_male.pptx",
+    (2, "female"): "story_book/Storybook_Template_2_female.pptx"
+}
+
+TEMPLATE_COVER_MAPPING = {
+    (1, "male"): "story_book/cover/Storybook_cover_1_male.pptx",
+    (1, "female"): "story_book/cover/Storybook_cover_1_female.pptx",
+    (2, "male"): "story_book/cover/Storybook_cover_2_male.pptx",
+    (2, "female"): "story_book/cover/Storybook_cover_2_female.pptx"
+}
+
+
+def get_template_paths(story_id: int, gender: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Get the story and cover template paths for a story/gender combination
+
+    Args:
+        story_id: The story identifier (e.g., 1 or 2)
+        gender: The gender (male or female), case insensitive
+
+    Returns:
+        Tuple of (story_template_path, cover_template_path), None where unmapped
+    """
+    template_key = (story_id, gender.lower())
+    return TEMPLATE_MAPPING.get(template_key), TEMPLATE_COVER_MAPPING.get(template_key)
+
+
+def all_template_keys() -> List[Tuple[int, str]]:
+    """Get every registered (story_id, gender) combination"""
+    return sorted(TEMPLATE_MAPPING.keys())
+
+
+def all_template_paths() -> List[str]:
+    """Get every registered story and cover template path"""
+    return sorted(set(TEMPLATE_MAPPING.values()) | set(TEMPLATE_COVER_MAPPING.values()))
+
+
+def build_replacements(name: str) -> Dict[str, str]:
+    """
+    Build the placeholder replacements for a child's name
+
+    Args:
+        name: The character name to use in the story
+
+    Returns:
+        Dictionary of {placeholder: replacement_text}
+    """
+    return {
+        '{{Child_Name}}': name,
+        '{{CHILD_NAME_UPPER}}': name.upper()
+    }
@@ -0,0 +1,112 @@
+"""
+Idempotency Tests
+Retries of /generate-pptx must reuse the first result and never hand one
+request's storybook to a different request.
+
+Run with:
+    python -m pytest test_idempotency.py
+"""
+
+import asyncio
+
+import pytest
+
+from idempotency import IdempotencyConflict, IdempotencyStore, IdempotentRunner, request_fingerprint
+
+
+EMMA = request_fingerprint(story_id=1, gender="female", name="Emma")
+LIAM = request_fingerprint(story_id=1, gender="male", name="Liam")
+
+
+def make_runner(tmp_path, **kwargs) -> IdempotentRunner:
+    store = IdempotencyStore(str(tmp_path / "keys.sqlite3"), ttl_seconds=3600, pending_timeout=60)
+    return IdempotentRunner(store, wait_timeout=5, poll_interval=0.05, **kwargs)
+
+
+def slow_generation(result, calls):
+    async def generate():
+        calls.append(result["name"])
+        await asyncio.sleep(0.2)
+        return result
+    return generate
+
+
+def test_key_reused_for_other_request_while_in_flight_is_rejected(tmp_path):
+    runner = make_runner(tmp_path)
+    calls = []
+
+    async def scenario():
+        first = asyncio.create_task(runner.run("k1", EMMA, slow_generation({"name": "Emma"}, calls)))
+        await asyncio.sleep(0.05)
+        with pytest.raises(IdempotencyConflict):
+            await runner.run("k1", LIAM, slow_generation({"name": "Liam"}, calls))
+        return await first
+
+    result, replayed = asyncio.run(scenario())
+    assert result == {"name": "Emma"}
+    assert not replayed
+    assert calls == ["Emma"]
+
+
+def test_concurrent_retries_generate_once(tmp_path):
+    runner = make_runner(tmp_path)
+    calls = []
+
+    async def scenario():
+        return await asyncio.gather(
+            runner.run("k1", EMMA, slow_generation({"name": "Emma"}, calls)),
+            runner.run("k1", EMMA, slow_generation({"name": "Emma"}, calls))
+        )
+
+    (first, first_replayed), (second, second_replayed) = asyncio.run(scenario())
+    assert first == second == {"name": "Emma"}
+    assert (first_replayed, second_replayed) == (False, True)
+    assert calls == ["Emma"]
+
+
+def test_finished_key_is_replayed_and_bound_to_its_request(tmp_path):
+    runner = make_runner(tmp_path)
+    calls = []
+
+    async def scenario():
+        await runner.run("k1", EMMA, slow_generation({"name": "Emma"}, calls))
+        replay = await runner.run("k1", EMMA, slow_generation({"name": "Emma"}, calls))
+        with pytest.raises(IdempotencyConflict):
+            await runner.run("k1", LIAM, slow_generation({"name": "Liam"}, calls))
+        return replay
+
+    assert asyncio.run(scenario()) == ({"name": "Emma"}, True)
+    assert calls == ["Emma"]
+
+
+def test_failed_generation_releases_the_key(tmp_path):
+    runner = make_runner(tmp_path)
+    calls = []
+
+    async def failing():
+        raise RuntimeError("conversion failed")
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await runner.run("k1", EMMA, failing)
+        return await runner.run("k1", EMMA, slow_generation({"name": "Emma"}, calls))
+
+    assert asyncio.run(scenario()) == ({"name": "Emma"}, False)
+    assert calls == ["Emma"]
+
+
+def test_retry_in_other_worker_waits_for_the_original(tmp_path):
+    # Two runners on one store stand in for two uvicorn workers
+    first_worker = make_runner(tmp_path)
+    second_worker = make_runner(tmp_path)
+    calls = []
+
+    async def scenario():
+        first = asyncio.create_task(first_worker.run("k1", EMMA, slow_generation({"name": "Emma"}, calls)))
+        await asyncio.sleep(0.05)
+        retry = await second_worker.run("k1", EMMA, slow_generation({"name": "Emma"}, calls))
+        await first
+        return retry
+
+    assert asyncio.run(scenario()) == ({"name": "Emma"}, True)
+    assert calls == ["Emma"]
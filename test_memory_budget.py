@@ -0,0 +1,121 @@
+"""
+Memory Budget Tests
+Jobs are admitted while they fit, wait in a bounded queue otherwise, and
+leave the queue cleanly whether they are admitted, shed, timed out or cancelled.
+
+Run with:
+    python -m pytest test_memory_budget.py
+"""
+
+import asyncio
+
+import pytest
+
+from memory_budget import MB, MemoryBudget, MemoryBudgetExceeded
+
+
+def make_budget(**kwargs) -> MemoryBudget:
+    # Two default-cost jobs fit; available_memory_bytes still applies, so costs stay small
+    options = dict(budget_bytes=200 * MB, default_cost_bytes=100 * MB, queue_timeout=5, max_queue=1)
+    options.update(kwargs)
+    return MemoryBudget(**options)
+
+
+def test_jobs_are_admitted_while_they_fit():
+    budget = make_budget()
+
+    async def scenario():
+        first = await budget.acquire("1:male")
+        second = await budget.acquire("1:female")
+        assert (budget.active_jobs, budget.reserved_bytes) == (2, 200 * MB)
+        first.release()
+        second.release()
+        second.release()
+
+    asyncio.run(scenario())
+    assert (budget.active_jobs, budget.reserved_bytes, budget.admitted_total) == (0, 0, 2)
+
+
+def test_queued_job_is_admitted_on_release():
+    budget = make_budget()
+
+    async def scenario():
+        held = [await budget.acquire("1:male"), await budget.acquire("1:male")]
+        waiting = asyncio.create_task(budget.acquire("1:male"))
+        await asyncio.sleep(0.05)
+        assert budget.queued_jobs == 1
+        held[0].release()
+        reservation = await waiting
+        assert budget.queued_jobs == 0
+        reservation.release()
+        held[1].release()
+
+    asyncio.run(scenario())
+    assert (budget.active_jobs, budget.reserved_bytes, budget.shed_total) == (0, 0, 0)
+
+
+def test_job_is_shed_when_the_queue_is_full():
+    budget = make_budget()
+
+    async def scenario():
+        held = [await budget.acquire("1:male"), await budget.acquire("1:male")]
+        waiting = asyncio.create_task(budget.acquire("1:male"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(MemoryBudgetExceeded):
+            await budget.acquire("1:male")
+        waiting.cancel()
+        for reservation in held:
+            reservation.release()
+
+    asyncio.run(scenario())
+    assert budget.shed_total == 1
+    assert budget.queued_jobs == 0
+
+
+def test_queued_job_times_out():
+    budget = make_budget(queue_timeout=0.1)
+
+    async def scenario():
+        held = [await budget.acquire("1:male"), await budget.acquire("1:male")]
+        with pytest.raises(MemoryBudgetExceeded):
+            await budget.acquire("1:male")
+        assert budget.queued_jobs == 0
+        assert budget._waiters == []
+        for reservation in held:
+            reservation.release()
+
+    asyncio.run(scenario())
+    assert budget.shed_total == 1
+
+
+def test_cancelled_job_leaves_the_queue():
+    budget = make_budget()
+
+    async def scenario():
+        held = [await budget.acquire("1:male"), await budget.acquire("1:male")]
+        waiting = asyncio.create_task(budget.acquire("1:male"))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert budget.queued_jobs == 0
+        assert budget._waiters == []
+        # The queue slot is free again, and background jobs are no longer held back
+        assert budget.try_acquire("1:male") is None
+        held[0].release()
+        background = budget.try_acquire("1:male")
+        assert background is not None
+        background.release()
+        held[1].release()
+
+    asyncio.run(scenario())
+    assert budget.shed_total == 0
+
+
+def test_learned_cost_never_drops_below_the_floor():
+    budget = make_budget(min_cost_bytes=64 * MB)
+    budget.record("1:male", 300 * MB)
+    assert budget.estimate("1:male") == 360 * MB
+    for _ in range(100):
+        budget.record("1:male", 1 * MB)
+    assert budget.estimate("1:male") == 64 * MB
@@ -0,0 +1,268 @@
+"""
+Cache Warming Job
+Pre-generate storybooks for the most popular names into the output cache,
+for every story/gender combination, at low priority and within a disk budget.
+
+Usage:
+    python warm_cache.py popular_names.txt --top 200 --budget-mb 4096
+
+The names file is ranked, one name per line (anything after a comma is ignored,
+so a "name,count" export works as-is).
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from memory_budget import MemoryBudget, job_key, memory_budget
+from output_cache import OutputCache, output_cache
+from template_registry import all_template_keys
+
+
+LOW_PRIORITY_NICE = 10
+
+
+def load_names(path: str, top: Optional[int] = None) -> List[str]:
+    """
+    Read a ranked name list
+
+    Args:
+        path: Text file, one name per line
+        top: Only keep the first N names (optional)
+
+    Returns:
+        List of unique names in rank order
+    """
+    names = []
+    seen = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            name = line.split(",")[0].strip()
+            if not name or name.startswith("#") or name in seen:
+                continue
+            seen.add(name)
+            names.append(name)
+            if top is not None and len(names) >= top:
+                break
+    return names
+
+
+def lower_priority():
+    """
+    Lower the scheduling priority of the calling thread
+
+    On Linux niceness is per thread and inherited by child processes, so the
+    LibreOffice conversions started from this thread run at low priority too.
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), LOW_PRIORITY_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+class GenerationActivity:
+    """
+    Live generations across every worker process on the host
+
+    While a process has a generation running it holds a shared flock on one
+    lock file, and the host is idle when an exclusive lock can be taken. The
+    lock goes away with its process, so a crashed worker never leaves the host
+    looking busy. Without flock (Windows) only this process is seen.
+    """
+
+    def __init__(self, lock_path: Path):
+        self.lock_path = Path(lock_path)
+        self.in_flight = 0
+        self._lock_file = None
+        self._lock = threading.Lock()
+
+    def begin(self) -> Callable[[], None]:
+        """
+        Mark a generation as running
+
+        Returns:
+            Function to call once, when the generation is done
+        """
+        with self._lock:
+            self.in_flight += 1
+            if self.in_flight == 1 and sys.platform != "win32":
+                import fcntl
+                if self._lock_file is None:
+                    self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+                    self._lock_file = open(self.lock_path, "a")
+                fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+        return self._end
+
+    def _end(self):
+        with self._lock:
+            self.in_flight -= 1
+            if self.in_flight == 0 and self._lock_file is not None:
+                import fcntl
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def is_idle(self) -> bool:
+        """True when no process on the host has a live generation running"""
+        with self._lock:
+            if self.in_flight:
+                return False
+        if sys.platform == "win32" or not self.lock_path.exists():
+            return True
+
+        import fcntl
+        with open(self.lock_path, "a") as probe:
+            try:
+                fcntl.flock(probe, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            fcntl.flock(probe, fcntl.LOCK_UN)
+        return True
+
+
+# Shared by the API workers and the warming job through the output cache folder
+generation_activity = GenerationActivity(output_cache.root / ".generating.lock")
+
+
+class CacheWarmer:
+    def __init__(
+        self,
+        names: List[str],
+        budget_bytes: int,
+        cache: OutputCache = output_cache,
+        is_idle: Optional[Callable[[], bool]] = None,
+        idle_poll_seconds: float = 1.0,
+        budget: MemoryBudget = memory_budget
+    ):
+        """
+        Initialize the Cache Warmer
+
+        Args:
+            names: Ranked names, most popular first
+            budget_bytes: Stop once the output cache would grow past this size
+            cache: OutputCache to fill
+            is_idle: Returns True when no live generation is running (optional, default: none on the host)
+            idle_poll_seconds: How long to wait before re-checking when busy
+            budget: MemoryBudget shared with live generation, so warming never overcommits memory
+        """
+        self.names = names
+        self.budget_bytes = budget_bytes
+        self.cache = cache
+        self.is_idle = is_idle or generation_activity.is_idle
+        self.idle_poll_seconds = idle_poll_seconds
+        self.budget = budget
+        self.generated = 0
+        self.skipped = 0
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def _wait_for_idle(self) -> bool:
+        while not self.is_idle():
+            if self._stop.wait(self.idle_poll_seconds):
+                return False
+        return not self._stop.is_set()
+
+    def _reserve(self, story_id: int, gender: str):
+        """Wait until the job fits in the memory budget; None if stopped first"""
+        while True:
+            reservation = self.budget.try_acquire(job_key(story_id, gender))
+            if reservation is not None:
+                return reservation
+            if self._stop.wait(self.idle_poll_seconds):
+                return None
+
+    def _acquire_lock(self):
+        """Take the warming lock so only one worker process per host warms at a time"""
+        self.cache.root.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.cache.root / ".warming.lock", "w")
+        if sys.platform != "win32":
+            import fcntl
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    def run(self):
+        """Warm the cache name by name, in rank order, until done, stopped or out of budget"""
+        lock_file = self._acquire_lock()
+        if lock_file is None:
+            print("ℹ️  Another process is already warming the output cache")
+            return
+        try:
+            self._run()
+        finally:
+            lock_file.close()
+
+    def _run(self):
+        lower_priority()
+
+        # Entries from earlier template versions would otherwise fill the budget for good
+        evicted = self.cache.evict_stale()
+        if evicted:
+            print(f"🧹 Removed {evicted} stale output cache entries")
+
+        usage = self.cache.usage_bytes()
+        average_entry = 0
+
+        for rank, name in enumerate(self.names, 1):
+            for story_id, gender in all_template_keys():
+                if not self._wait_for_idle():
+                    return
+
+                if self.cache.lookup(story_id, gender, name) is not None:
+                    self.skipped += 1
+                    continue
+
+                if usage + average_entry > self.budget_bytes:
+                    print(f"⚠️  Disk budget reached ({usage / (1024 * 1024):.1f} MB), stopping at rank {rank}")
+                    return
+
+                reservation = self._reserve(story_id, gender)
+                if reservation is None:
+                    return
+                try:
+                    artifacts = self.budget.run_measured(reservation, self.cache.generate, story_id, gender, name)
+                except Exception as e:
+                    print(f"❌ Warming failed for {name} (story {story_id}, {gender}): {e}")
+                    continue
+                finally:
+                    reservation.release()
+
+                entry = self.cache.entry_bytes(artifacts)
+                usage += entry
+                self.generated += 1
+                average_entry += (entry - average_entry) / self.generated
+
+        print(f"🎉 Cache warming finished: {self.generated} generated, {self.skipped} already cached")
+
+    def start(self) -> threading.Thread:
+        """Run in a background daemon thread"""
+        thread = threading.Thread(target=self.run, name="cache-warmer", daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate storybooks for popular names")
+    parser.add_argument("names_file", help="Ranked names, one per line")
+    parser.add_argument("--top", type=int, default=None, help="Only warm the first N names")
+    parser.add_argument("--budget-mb", type=int, default=2048, help="Disk budget for the output cache")
+    args = parser.parse_args()
+
+    names = load_names(args.names_file, args.top)
+    print(f"🔥 Warming output cache for {len(names)} names...")
+
+    started = time.perf_counter()
+    warmer = CacheWarmer(names, args.budget_mb * 1024 * 1024)
+    warmer.run()
+    print(f"   - Took {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()